@@ -0,0 +1 @@
+"""Lattice agent: pairs with a master, streams heartbeats, logs, and VM state."""
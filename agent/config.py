@@ -0,0 +1,41 @@
+"""Agent configuration loaded from the environment."""
+
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+DEFAULT_MASTER_URL = "http://127.0.0.1:8787"
+DEFAULT_LOG_PATH = Path.home() / ".lattice" / "agent.log"
+DEFAULT_STATE_PATH = Path.home() / ".lattice" / "agent-state.json"
+
+
+@dataclass
+class AgentConfig:
+    master_url: str
+    pair_code: str
+    heartbeat_seconds: int = 30
+    pair_retry_seconds: int = 5
+    reconnect_seconds: int = 5
+    log_path: Path = DEFAULT_LOG_PATH
+    state_path: Path = DEFAULT_STATE_PATH
+
+
+def load_config() -> AgentConfig:
+    master_url = os.environ.get("LATTICE_MASTER_URL", DEFAULT_MASTER_URL).rstrip("/")
+    pair_code = os.environ.get("LATTICE_PAIR_CODE", "").strip()
+    heartbeat_seconds = int(os.environ.get("LATTICE_HEARTBEAT_SECONDS", "30"))
+    pair_retry_seconds = int(os.environ.get("LATTICE_PAIR_RETRY_SECONDS", "5"))
+    reconnect_seconds = int(os.environ.get("LATTICE_RECONNECT_SECONDS", "5"))
+    log_path = Path(os.environ.get("LATTICE_AGENT_LOG", str(DEFAULT_LOG_PATH)))
+    state_path = Path(os.environ.get("LATTICE_AGENT_STATE", str(DEFAULT_STATE_PATH)))
+    return AgentConfig(
+        master_url=master_url,
+        pair_code=pair_code,
+        heartbeat_seconds=max(5, heartbeat_seconds),
+        pair_retry_seconds=max(1, pair_retry_seconds),
+        reconnect_seconds=max(1, reconnect_seconds),
+        log_path=log_path,
+        state_path=state_path,
+    )
@@ -0,0 +1,68 @@
+"""Periodic heartbeat POSTs to the master."""
+
+from __future__ import annotations
+
+import logging
+import threading
+
+import requests
+
+from .system import build_heartbeat_extra
+
+log = logging.getLogger("lattice.agent.heartbeat")
+
+
+class HeartbeatSender:
+    """Background thread that POSTs a heartbeat every `interval_seconds`."""
+
+    def __init__(
+        self,
+        master_url: str,
+        node_id: str,
+        pair_token: str,
+        interval_seconds: int = 30,
+        session: requests.Session | None = None,
+    ) -> None:
+        self.master_url = master_url.rstrip("/")
+        self.node_id = node_id
+        self.pair_token = pair_token
+        self.interval_seconds = max(5, interval_seconds)
+        # Sharing the pair client's session reuses its TLS connection instead
+        # of opening a fresh one per beat.
+        self._session = session if session is not None else requests.Session()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="agent-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._send_once()
+            except Exception as exc:
+                log.warning("heartbeat failed: %s", exc)
+            self._stop_event.wait(self.interval_seconds)
+
+    def _send_once(self) -> None:
+        payload = {
+            "node_id": self.node_id,
+            "pair_token": self.pair_token,
+        }
+        payload.update(build_heartbeat_extra())
+        response = self._session.post(
+            f"{self.master_url}/api/agent/heartbeat",
+            json=payload,
+            timeout=10,
+        )
+        if response.status_code != 200:
+            log.warning("heartbeat rejected (status=%s)", response.status_code)
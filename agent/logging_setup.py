@@ -0,0 +1,73 @@
+"""Logger wiring for the agent process."""
+
+from __future__ import annotations
+
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+
+
+# Standard levels resolved by number; non-standard ones fall back to the
+# per-record lowercasing.
+_LEVEL_NAMES = {
+    logging.DEBUG: "debug",
+    logging.INFO: "info",
+    logging.WARNING: "warning",
+    logging.ERROR: "error",
+    logging.CRITICAL: "critical",
+}
+
+
+class HumanFormatter(logging.Formatter):
+    """Compact single-line formatter for the rotating file / stderr."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = self.formatTime(record, "%Y-%m-%dT%H:%M:%S")
+        level = _LEVEL_NAMES.get(record.levelno) or record.levelname.lower()
+        message = f"[lattice] {timestamp} {level} {record.name} {record.getMessage()}"
+        extra = record.__dict__.get("extra")
+        if extra is None:
+            return message
+        return f"{message} | data={extra}"
+
+
+class DropOnFullQueueHandler(QueueHandler):
+    """QueueHandler that silently drops records when the queue is full.
+
+    Losing a log line is preferable to blocking (or error-spamming) every
+    thread that logs while a downstream handler is stalled.
+    """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logger(log_path: Path, level: int = logging.INFO) -> logging.Logger:
+    """Wire the agent logger with file/stderr output behind a queue.
+
+    Callers pay only a SimpleQueue enqueue per record; the rotating-file
+    and stderr writes happen on the listener thread. The listener is
+    stashed on the logger so shutdown code can stop() it.
+    """
+    logger = logging.getLogger("lattice.agent")
+    logger.setLevel(level)
+    if logger.handlers:
+        return logger
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    handler = RotatingFileHandler(log_path, maxBytes=5 * 1024 * 1024, backupCount=3)
+    handler.setFormatter(HumanFormatter())
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(HumanFormatter())
+    record_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(record_queue))
+    listener = QueueListener(
+        record_queue, handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    logger._lattice_listener = listener  # type: ignore[attr-defined]
+    return logger
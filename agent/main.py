@@ -0,0 +1,113 @@
+"""Agent entry point: pair, then stream heartbeats, logs, and command results."""
+
+from __future__ import annotations
+
+import logging
+import logging.handlers
+import queue
+import signal
+import threading
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from .config import load_config
+from .heartbeat import HeartbeatSender
+from .logging_setup import DropOnFullQueueHandler, setup_logger
+from .pairing import pair_until_success
+from .system import build_heartbeat_extra
+from .vm import execute_vm_command
+from .ws_stream import AgentWebSocketStreamer, WebSocketLogHandler, build_agent_ws_url
+
+
+def _build_http_session() -> requests.Session:
+    """One keep-alive session shared by pairing and heartbeats."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=4,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def main() -> None:
+    config = load_config()
+    log = setup_logger(config.log_path)
+    log.info("lattice agent starting (master=%s)", config.master_url)
+
+    session = _build_http_session()
+    pairing = pair_until_success(config, session=session)
+    node_id = str(pairing["node_id"])
+    pair_token = str(pairing["pair_token"])
+
+    streamer = AgentWebSocketStreamer(
+        ws_url=build_agent_ws_url(config.master_url),
+        node_id=node_id,
+        pair_token=pair_token,
+        reconnect_seconds=config.reconnect_seconds,
+        command_handler=_make_command_handler(),
+    )
+    streamer.start()
+
+    # Decouple log emission from the WS streamer: callers enqueue instantly
+    # and a listener thread drains to the handler, so a stalled WebSocket
+    # can never block a thread that merely calls log.info().
+    ws_log_handler = WebSocketLogHandler(streamer)
+    ws_log_handler.setLevel(logging.INFO)
+    log_queue: queue.Queue = queue.Queue(maxsize=10_000)
+    log_listener = logging.handlers.QueueListener(
+        log_queue, ws_log_handler, respect_handler_level=True
+    )
+    ws_queue_handler = DropOnFullQueueHandler(log_queue)
+    log.addHandler(ws_queue_handler)
+    log_listener.start()
+
+    heartbeat = HeartbeatSender(
+        master_url=config.master_url,
+        node_id=node_id,
+        pair_token=pair_token,
+        interval_seconds=config.heartbeat_seconds,
+        session=session,
+    )
+    heartbeat.start()
+    streamer.send_heartbeat(build_heartbeat_extra())
+
+    stop_event = threading.Event()
+
+    def _handle_signal(signum: int, _frame: Any) -> None:
+        log.info("received signal %s, shutting down", signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, _handle_signal)
+    signal.signal(signal.SIGTERM, _handle_signal)
+    stop_event.wait()
+
+    heartbeat.stop()
+    log.removeHandler(ws_queue_handler)
+    log_listener.stop()
+    streamer.stop()
+    file_listener = getattr(log, "_lattice_listener", None)
+    if file_listener is not None:
+        file_listener.stop()
+
+
+def _make_command_handler():
+    def handle(inbound: dict[str, Any]) -> None:
+        command = inbound.get("command") or {}
+        result = execute_vm_command(command)
+        log = logging.getLogger("lattice.agent")
+        log.info(
+            "command %s finished ok=%s",
+            command.get("operation_type"),
+            result.get("ok"),
+        )
+
+    return handle
+
+
+if __name__ == "__main__":
+    main()
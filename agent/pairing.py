@@ -0,0 +1,79 @@
+"""Pairing handshake against the master's HTTP API."""
+
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any
+
+import requests
+
+from .config import AgentConfig
+from .system import get_system_info
+
+log = logging.getLogger("lattice.agent.pairing")
+
+
+def _request_pair_once(
+    config: AgentConfig,
+    session: requests.Session | None = None,
+) -> tuple[int, dict[str, Any] | None]:
+    """Attempt one pair request. Returns (status_code, payload-or-None)."""
+    payload = {
+        "pair_code": config.pair_code,
+        "agent_info": get_system_info(),
+    }
+    client = session if session is not None else requests
+    response = client.post(
+        f"{config.master_url}/api/agent/pair",
+        json=payload,
+        timeout=10,
+    )
+    if response.status_code == 200:
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+    return response.status_code, None
+
+
+_PAIR_BACKOFF_CAP_SECONDS = 300.0
+
+
+def pair_until_success(
+    config: AgentConfig,
+    session: requests.Session | None = None,
+) -> dict[str, Any]:
+    """Keep attempting the pair handshake until the master accepts us.
+
+    Repeats of the same failure back off exponentially (capped at 5 minutes)
+    so a persistent error does not hammer the master at a fixed interval; any
+    change in failure mode resets the delay to the configured base.
+    """
+    backoff = float(config.pair_retry_seconds)
+    last_status: int | None = None
+    while True:
+        try:
+            status, payload = _request_pair_once(config, session=session)
+        except requests.RequestException as exc:
+            log.warning("pair attempt failed: %s", exc)
+            status = 0
+        else:
+            if status == 200 and isinstance(payload, dict) and payload.get("node_id"):
+                log.info("paired with master as node %s", payload["node_id"])
+                return payload
+            if status == 400:
+                log.warning(
+                    "master rejected pair_code %r; verify the code shown on the master",
+                    config.pair_code,
+                )
+            else:
+                log.warning("pair attempt rejected (status=%s)", status)
+        if status == last_status:
+            # Bad pair codes won't fix themselves quickly; back off harder.
+            factor = 4 if status == 400 else 2
+            backoff = min(backoff * factor, _PAIR_BACKOFF_CAP_SECONDS)
+        else:
+            backoff = float(config.pair_retry_seconds)
+            last_status = status
+        time.sleep(backoff)
@@ -0,0 +1,127 @@
+"""System inspection helpers for heartbeat payloads."""
+
+from __future__ import annotations
+
+import os
+import platform
+import socket
+import threading
+import time
+from typing import Any
+
+try:
+    import psutil
+except ImportError:  # pragma: no cover - psutil is optional
+    psutil = None
+
+
+def _build_system_info() -> dict[str, Any]:
+    if hasattr(os, "uname"):
+        # One syscall covers the whole OS bundle; platform.version() in
+        # particular can shell out to uname -v on some platforms.
+        uname = os.uname()
+        os_info = {
+            "name": uname.sysname,
+            "release": uname.release,
+            "version": uname.version,
+            "machine": uname.machine,
+            "node": uname.nodename,
+        }
+    else:  # pragma: no cover - Windows has no os.uname
+        os_info = {
+            "name": platform.system(),
+            "release": platform.release(),
+            "version": platform.version(),
+            "machine": platform.machine(),
+            "node": platform.node(),
+        }
+    return {
+        "hostname": socket.gethostname(),
+        "os": os_info,
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+# None of this changes while the process lives; probe the platform once.
+_SYSTEM_INFO = _build_system_info()
+
+
+def get_system_info() -> dict[str, Any]:
+    """Return a static description of the host OS and hardware."""
+    return _SYSTEM_INFO
+
+
+_SAMPLE_PAUSE_SECONDS = 1.0
+
+
+class _MetricsSampler(threading.Thread):
+    """Daemon thread that keeps a fresh runtime-metrics snapshot.
+
+    psutil's cpu_percent(interval=None) reports the delta since the previous
+    call, so sampling it only when a heartbeat fires yields a whole-interval
+    average instead of a current reading. Sampling continuously here keeps the
+    numbers fresh and turns get_runtime_metrics into a plain dict read with no
+    syscalls on the caller's thread.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(name="agent-metrics-sampler", daemon=True)
+        self.snapshot: dict[str, Any] = {}
+
+    def run(self) -> None:
+        while True:
+            metrics: dict[str, Any] = {}
+            try:
+                metrics["cpu_percent"] = psutil.cpu_percent(interval=1.0)
+                memory = psutil.virtual_memory()
+                metrics["memory_percent"] = memory.percent
+                metrics["memory_used_bytes"] = memory.used
+                metrics["memory_total_bytes"] = memory.total
+                disk = psutil.disk_usage("/")
+                metrics["disk_percent"] = disk.percent
+                metrics["disk_used_bytes"] = disk.used
+                metrics["disk_total_bytes"] = disk.total
+            except Exception:
+                metrics = {}
+            # Reference assignment is atomic under the GIL: readers see either
+            # the previous snapshot or this one, never a partial dict.
+            self.snapshot = metrics
+            time.sleep(_SAMPLE_PAUSE_SECONDS)
+
+
+_sampler: _MetricsSampler | None = None
+_sampler_lock = threading.Lock()
+
+
+def _ensure_sampler() -> _MetricsSampler:
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                sampler = _MetricsSampler()
+                sampler.start()
+                _sampler = sampler
+    return _sampler
+
+
+# Resolve the optional-psutil branch once at import instead of per heartbeat.
+if psutil is None:
+
+    def get_runtime_metrics() -> dict[str, Any]:
+        """Runtime metrics are unavailable without psutil."""
+        return {}
+
+else:
+
+    def get_runtime_metrics() -> dict[str, Any]:
+        """Return the sampler's latest utilization snapshot."""
+        return dict(_ensure_sampler().snapshot)
+
+
+def build_heartbeat_extra() -> dict[str, Any]:
+    """Assemble the non-identity portion of a heartbeat."""
+    return {
+        "system": get_system_info(),
+        "runtime_metrics": get_runtime_metrics(),
+    }
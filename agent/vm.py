@@ -0,0 +1,997 @@
+"""KVM/libvirt VM management executed on the agent host via virsh."""
+
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+from urllib import request
+
+try:
+    import libvirt
+except ImportError:  # pragma: no cover - libvirt bindings are optional
+    libvirt = None
+
+log = logging.getLogger("lattice.agent.vm")
+
+IMAGE_ROOT = Path("/var/lib/lattice/images")
+VM_ROOT = Path("/var/lib/lattice/vms")
+
+_IPV4_REGEX = re.compile(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})")
+
+_CAPABILITY_LOCK = threading.Lock()
+_CAPABILITY_CACHE: dict[str, Any] = {
+    "value": None,
+    "at": 0.0,
+    "fingerprint": None,
+    "probe_at": 0.0,
+}
+
+# How long a virsh probe result stays valid while the cheap prerequisites
+# (OS, tool availability) are unchanged.
+_PROBE_REUSE_SECONDS = 5.0
+
+_VM_SYNC_CACHE_SECONDS = 1.0
+_VM_SYNC_CACHE: dict[str, Any] = {"domains": None, "at": 0.0}
+
+_REQUIRED_TOOLS = (
+    "virsh",
+    "virt-install",
+    "qemu-img",
+    "cloud-localds",
+    "genisoimage",
+    "qemu-system-x86_64",
+    "ip",
+    "systemctl",
+    "sudo",
+)
+
+_WHICH_CACHE: dict[tuple[str, str], str | None] = {}  # guarded by _CAPABILITY_LOCK
+
+
+def _cached_which(tool: str) -> str | None:
+    """shutil.which memoized per (tool, PATH).
+
+    which() stats every candidate along PATH; capability checks probe the same
+    tool list repeatedly, so amortize the filesystem walk until PATH changes.
+    """
+    key = (tool, os.environ.get("PATH", ""))
+    with _CAPABILITY_LOCK:
+        if key in _WHICH_CACHE:
+            return _WHICH_CACHE[key]
+    resolved = shutil.which(tool)
+    with _CAPABILITY_LOCK:
+        _WHICH_CACHE[key] = resolved
+    return resolved
+
+_LIBVIRT_CONN: Any = None  # guarded by _CAPABILITY_LOCK
+_LIBVIRT_EVENT_THREAD: threading.Thread | None = None  # guarded by _CAPABILITY_LOCK
+
+_STOP_TIMEOUT_SECONDS = 24
+
+if libvirt is not None:
+    _LIBVIRT_STATE_MAP = {
+        libvirt.VIR_DOMAIN_NOSTATE: "no state",
+        libvirt.VIR_DOMAIN_RUNNING: "running",
+        libvirt.VIR_DOMAIN_BLOCKED: "blocked",
+        libvirt.VIR_DOMAIN_PAUSED: "paused",
+        libvirt.VIR_DOMAIN_SHUTDOWN: "in shutdown",
+        libvirt.VIR_DOMAIN_SHUTOFF: "shut off",
+        libvirt.VIR_DOMAIN_CRASHED: "crashed",
+        libvirt.VIR_DOMAIN_PMSUSPENDED: "pmsuspended",
+    }
+else:
+    _LIBVIRT_STATE_MAP = {}
+
+
+def _libvirt_conn() -> Any:
+    """Return a shared qemu:///system connection, or None if unavailable.
+
+    A virConnect call over the local socket costs microseconds where a virsh
+    subprocess costs tens of milliseconds, so every helper prefers this path
+    and falls back to virsh when the bindings or the daemon are absent.
+    """
+    global _LIBVIRT_CONN
+    if libvirt is None:
+        return None
+    with _CAPABILITY_LOCK:
+        conn = _LIBVIRT_CONN
+        if conn is not None:
+            try:
+                if conn.isAlive():
+                    return conn
+            except libvirt.libvirtError:
+                pass
+            _LIBVIRT_CONN = None
+        _ensure_libvirt_event_loop()
+        try:
+            conn = libvirt.open("qemu:///system")
+        except libvirt.libvirtError as exc:
+            log.debug("libvirt connection unavailable, using virsh: %s", exc)
+            return None
+        _LIBVIRT_CONN = conn
+        return conn
+
+
+def _ensure_libvirt_event_loop() -> None:
+    """Start the default libvirt event loop once.
+
+    Lifecycle callbacks only fire on connections opened after the default
+    event implementation is registered, so this runs before libvirt.open.
+    Callers already hold _CAPABILITY_LOCK.
+    """
+    global _LIBVIRT_EVENT_THREAD
+    if _LIBVIRT_EVENT_THREAD is not None:
+        return
+    libvirt.virEventRegisterDefaultImpl()
+
+    def _run_event_loop() -> None:
+        while True:
+            try:
+                libvirt.virEventRunDefaultImpl()
+            except Exception:
+                time.sleep(0.5)
+
+    thread = threading.Thread(target=_run_event_loop, name="libvirt-events", daemon=True)
+    thread.start()
+    _LIBVIRT_EVENT_THREAD = thread
+
+
+def _lookup_domain(conn: Any, domain_name: str) -> Any:
+    try:
+        return conn.lookupByName(domain_name)
+    except libvirt.libvirtError:
+        return None
+
+
+def _run_sudo(args: list[str], timeout: int = 120) -> subprocess.CompletedProcess:
+    """Run a command under non-interactive sudo."""
+    return subprocess.run(
+        ["sudo", "-n", *args],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+
+
+# One alternation compiled at import: a single scan over the output instead
+# of one str.__contains__ pass per marker, and IGNORECASE avoids allocating a
+# lowercased copy of a potentially multi-KB error blob.
+_APT_LOCK_RE = re.compile(
+    "|".join(
+        map(
+            re.escape,
+            (
+                "could not get lock",
+                "unable to acquire the dpkg frontend lock",
+                "unable to lock the administration directory",
+                "is another process using it",
+                "dpkg frontend is locked",
+            ),
+        )
+    ),
+    re.IGNORECASE,
+)
+
+_MISSING_DOMAIN_RE = re.compile(
+    "|".join(
+        map(
+            re.escape,
+            (
+                "failed to get domain",
+                "domain not found",
+                "no domain with matching name",
+                "no domain with name",
+            ),
+        )
+    ),
+    re.IGNORECASE,
+)
+
+
+def _looks_like_apt_lock_error(stdout: str, stderr: str) -> bool:
+    return bool(_APT_LOCK_RE.search(f"{stdout}\n{stderr}"))
+
+
+def _looks_like_missing_domain_error(stdout: str, stderr: str) -> bool:
+    return bool(_MISSING_DOMAIN_RE.search(f"{stdout}\n{stderr}"))
+
+
+def _run_sudo_with_retry(
+    args: list[str],
+    timeout: int = 120,
+    budget_seconds: float = 30.0,
+    base_delay_ms: int = 200,
+    max_delay_ms: int = 8000,
+    retry_on: Callable[[str, str], bool] | None = None,
+) -> subprocess.CompletedProcess:
+    """Run a sudo command, retrying transient failures with backoff and jitter.
+
+    Short-lived conditions (a dpkg lock held for a few hundred ms) are retried
+    almost immediately; the delay doubles per attempt up to max_delay_ms, and
+    retries stop once budget_seconds of wall clock would be exceeded.
+    """
+    deadline = time.monotonic() + budget_seconds
+    attempt = 1
+    result = _run_sudo(args, timeout=timeout)
+    while result.returncode != 0:
+        if retry_on is None or not retry_on(result.stdout, result.stderr):
+            break
+        delay_ms = min(max_delay_ms, base_delay_ms * 2 ** (attempt - 1))
+        delay = (delay_ms + random.uniform(0, 100)) / 1000.0
+        if time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        result = _run_sudo(args, timeout=timeout)
+        attempt += 1
+    return result
+
+
+def _detect_linux_package_manager() -> str | None:
+    for candidate in ("apt-get", "apt", "dnf", "yum", "zypper"):
+        if _cached_which(candidate):
+            return candidate
+    return None
+
+
+def _detect_capability() -> dict[str, Any]:
+    """Probe the host for VM support: OS, tool availability, libvirt reachability."""
+    if platform.system() != "Linux":
+        return {
+            "ready": False,
+            "reason": "vm support requires Linux/KVM",
+            "missing_tools": [],
+        }
+    missing_tools = [tool for tool in _REQUIRED_TOOLS if _cached_which(tool) is None]
+    if missing_tools:
+        return {
+            "ready": False,
+            "reason": f"missing tools: {', '.join(missing_tools)}",
+            "missing_tools": missing_tools,
+        }
+    # The cheap half (OS + tools) passed; skip the sudo+virsh probe if a
+    # recent probe ran against the same fingerprint. This keeps callers that
+    # force max_age_seconds=0 from paying a subprocess every time.
+    fingerprint = ("Linux", tuple(missing_tools))
+    with _CAPABILITY_LOCK:
+        cached_value = _CAPABILITY_CACHE["value"]
+        if (
+            cached_value is not None
+            and _CAPABILITY_CACHE["fingerprint"] == fingerprint
+            and time.monotonic() - _CAPABILITY_CACHE["probe_at"] < _PROBE_REUSE_SECONDS
+        ):
+            return cached_value
+    probe = _run_sudo(["virsh", "list", "--all"], timeout=20)
+    with _CAPABILITY_LOCK:
+        _CAPABILITY_CACHE["fingerprint"] = fingerprint
+        _CAPABILITY_CACHE["probe_at"] = time.monotonic()
+    if probe.returncode != 0:
+        return {
+            "ready": False,
+            "reason": f"virsh probe failed: {probe.stderr.strip() or probe.stdout.strip()}",
+            "missing_tools": [],
+        }
+    return {"ready": True, "reason": "", "missing_tools": []}
+
+
+# Default sudoers timestamp_timeout is 5 minutes; refresh ahead of expiry.
+_SUDO_PRIME_INTERVAL_SECONDS = 240.0
+_SUDO_PRIME_STARTED = False  # guarded by _CAPABILITY_LOCK
+
+
+def _prime_sudo() -> None:
+    """Keep sudo's timestamp cache warm so -n calls skip the PAM stack.
+
+    Every _run_sudo still goes through sudo, but with a fresh timestamp it
+    hits the fast path instead of re-validating credentials per command.
+    Reschedules itself on a daemon Timer.
+    """
+    try:
+        subprocess.run(["sudo", "-n", "-v"], capture_output=True, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return
+    timer = threading.Timer(_SUDO_PRIME_INTERVAL_SECONDS, _prime_sudo)
+    timer.daemon = True
+    timer.start()
+
+
+def _refresh_capability_cache(value: dict[str, Any]) -> None:
+    global _SUDO_PRIME_STARTED
+    prime = False
+    with _CAPABILITY_LOCK:
+        _CAPABILITY_CACHE["value"] = value
+        _CAPABILITY_CACHE["at"] = time.monotonic()
+        if value.get("ready") and not _SUDO_PRIME_STARTED:
+            _SUDO_PRIME_STARTED = True
+            prime = True
+    if prime:
+        _prime_sudo()
+
+
+def get_vm_capability(max_age_seconds: float = 60.0) -> dict[str, Any]:
+    """Return the cached capability result, refreshing when stale."""
+    with _CAPABILITY_LOCK:
+        cached = _CAPABILITY_CACHE["value"]
+        age = time.monotonic() - _CAPABILITY_CACHE["at"]
+    if cached is not None and age < max_age_seconds:
+        return cached
+    value = _detect_capability()
+    _refresh_capability_cache(value)
+    return value
+
+
+def _install_linux_prerequisites(package_manager: str, missing_tools: list[str]) -> tuple[bool, str]:
+    """Best-effort install of virtualization packages for the missing tools."""
+    if package_manager not in ("apt-get", "apt"):
+        return False, f"unsupported package manager: {package_manager}"
+    packages = [
+        "qemu-kvm",
+        "libvirt-daemon-system",
+        "libvirt-clients",
+        "virtinst",
+        "cloud-image-utils",
+        "genisoimage",
+    ]
+    update = _run_sudo_with_retry(
+        [package_manager, "update"],
+        timeout=600,
+        budget_seconds=60.0,
+        retry_on=_looks_like_apt_lock_error,
+    )
+    if update.returncode != 0:
+        return False, f"{package_manager} update failed: {update.stderr.strip()}"
+    install = _run_sudo_with_retry(
+        [package_manager, "install", "-y", *packages],
+        timeout=1800,
+        budget_seconds=60.0,
+        retry_on=_looks_like_apt_lock_error,
+    )
+    if install.returncode != 0:
+        return False, f"{package_manager} install failed: {install.stderr.strip()}"
+    # New binaries appeared without PATH changing; drop stale which() results.
+    with _CAPABILITY_LOCK:
+        _WHICH_CACHE.clear()
+    return True, ""
+
+
+def auto_install_vm_prerequisites() -> dict[str, Any]:
+    """Detect capability and attempt to install whatever is missing.
+
+    Only an actual install invalidates what we just detected, so the no-op
+    branches reuse the capability result in hand instead of paying a second
+    sudo+virsh probe.
+    """
+    capability = _detect_capability()
+    if capability["ready"]:
+        _refresh_capability_cache(capability)
+        return {"attempted": False, "ok": True, "detail": "already ready", "capability": capability}
+    if platform.system() != "Linux":
+        _refresh_capability_cache(capability)
+        return {"attempted": False, "ok": False, "detail": capability["reason"], "capability": capability}
+    package_manager = _detect_linux_package_manager()
+    if package_manager is None:
+        _refresh_capability_cache(capability)
+        return {"attempted": False, "ok": False, "detail": "no supported package manager", "capability": capability}
+    ok, detail = _install_linux_prerequisites(package_manager, capability["missing_tools"])
+    refreshed = _detect_capability()
+    _refresh_capability_cache(refreshed)
+    return {"attempted": True, "ok": ok, "detail": detail, "capability": refreshed}
+
+
+_DOMINFO_STATE_RE = re.compile(r"^State:\s+(.+)$", re.MULTILINE)
+_DOMINFO_UUID_RE = re.compile(r"^UUID:\s+(.+)$", re.MULTILINE)
+
+
+def _domain_snapshot(domain_name: str, with_ip: bool = True) -> dict[str, str]:
+    """Fetch state, UUID, and (optionally) IP in at most two virsh calls.
+
+    virsh dominfo reports both State and UUID, so building a command-result
+    dict costs one subprocess instead of the domstate/domuuid/domifaddr trio.
+    With libvirt bindings present it costs no subprocess at all.
+    """
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return {"state": "absent", "domain_uuid": "", "ip_address": ""}
+        try:
+            state, _ = dom.state()
+            snapshot = {
+                "state": _LIBVIRT_STATE_MAP.get(state, "unknown"),
+                "domain_uuid": dom.UUIDString(),
+                "ip_address": "",
+            }
+        except libvirt.libvirtError:
+            return {"state": "unknown", "domain_uuid": "", "ip_address": ""}
+        if with_ip:
+            snapshot["ip_address"] = _domain_ip(domain_name)
+        return snapshot
+    info = _run_sudo(["virsh", "dominfo", domain_name], timeout=20)
+    if info.returncode != 0:
+        if _looks_like_missing_domain_error(info.stdout, info.stderr):
+            return {"state": "absent", "domain_uuid": "", "ip_address": ""}
+        return {"state": "unknown", "domain_uuid": "", "ip_address": ""}
+    state_match = _DOMINFO_STATE_RE.search(info.stdout)
+    uuid_match = _DOMINFO_UUID_RE.search(info.stdout)
+    snapshot = {
+        "state": state_match.group(1).strip() if state_match else "unknown",
+        "domain_uuid": uuid_match.group(1).strip() if uuid_match else "",
+        "ip_address": "",
+    }
+    if with_ip:
+        snapshot["ip_address"] = _domain_ip(domain_name)
+    return snapshot
+
+
+def _domain_state(domain_name: str) -> str:
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return "absent"
+        try:
+            state, _ = dom.state()
+        except libvirt.libvirtError:
+            return "unknown"
+        return _LIBVIRT_STATE_MAP.get(state, "unknown")
+    result = _run_sudo(["virsh", "domstate", domain_name], timeout=20)
+    if result.returncode != 0:
+        if _looks_like_missing_domain_error(result.stdout, result.stderr):
+            return "absent"
+        return "unknown"
+    return result.stdout.strip() or "unknown"
+
+
+def _domain_uuid(domain_name: str) -> str:
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return ""
+        try:
+            return dom.UUIDString()
+        except libvirt.libvirtError:
+            return ""
+    result = _run_sudo(["virsh", "domuuid", domain_name], timeout=20)
+    if result.returncode != 0:
+        return ""
+    return result.stdout.strip()
+
+
+def _domain_ip(domain_name: str) -> str:
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return ""
+        try:
+            interfaces = dom.interfaceAddresses(
+                libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT
+            )
+        except libvirt.libvirtError:
+            return ""
+        for name, data in interfaces.items():
+            if name == "lo":
+                continue
+            for addr in data.get("addrs") or []:
+                if addr.get("type") != libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    continue
+                value = str(addr.get("addr") or "")
+                if value and not value.startswith("127."):
+                    return value
+        return ""
+    result = _run_sudo(
+        ["virsh", "domifaddr", domain_name, "--source", "agent"],
+        timeout=20,
+    )
+    if result.returncode != 0:
+        return ""
+    for line in result.stdout.splitlines():
+        if "lo" in line.split():
+            continue
+        match = _IPV4_REGEX.search(line)
+        if match and not match.group(1).startswith("127."):
+            return match.group(1)
+    return ""
+
+
+def _start_domain(domain_name: str) -> str:
+    """Start a domain; returns '' on success or an error message."""
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return f"domain {domain_name} not found"
+        try:
+            if not dom.isActive():
+                dom.create()
+            return ""
+        except libvirt.libvirtError as exc:
+            return f"libvirt start failed: {exc}"
+    result = _run_sudo(["virsh", "start", domain_name], timeout=60)
+    if result.returncode != 0 and "already active" not in result.stderr:
+        return f"virsh start failed: {result.stderr.strip()}"
+    return ""
+
+
+def _shutdown_domain(domain_name: str) -> str:
+    """Request an ACPI shutdown; missing domains are treated as success."""
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return ""
+        try:
+            if dom.isActive():
+                dom.shutdown()
+            return ""
+        except libvirt.libvirtError as exc:
+            return f"libvirt shutdown failed: {exc}"
+    result = _run_sudo(["virsh", "shutdown", domain_name], timeout=60)
+    if result.returncode != 0 and not _looks_like_missing_domain_error(
+        result.stdout, result.stderr
+    ):
+        return f"virsh shutdown failed: {result.stderr.strip()}"
+    return ""
+
+
+def _reboot_domain(domain_name: str) -> str:
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is None:
+            return f"domain {domain_name} not found"
+        try:
+            dom.reboot(0)
+            return ""
+        except libvirt.libvirtError as exc:
+            return f"libvirt reboot failed: {exc}"
+    result = _run_sudo(["virsh", "reboot", domain_name], timeout=60)
+    if result.returncode != 0:
+        return f"virsh reboot failed: {result.stderr.strip()}"
+    return ""
+
+
+def _stop_domain(domain_name: str) -> str:
+    """Shut down a domain and wait for it to stop; hard-destroy on timeout.
+
+    With libvirt available this blocks on a lifecycle event and returns the
+    moment qemu reports the domain stopped; without it, fall back to polling.
+    Returns '' on success or an error message.
+    """
+    conn = _libvirt_conn()
+    callback_id = None
+    if conn is not None:
+        stopped = threading.Event()
+
+        def _on_lifecycle(_conn: Any, dom: Any, event: int, _detail: int, _opaque: Any) -> None:
+            if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and dom.name() == domain_name:
+                stopped.set()
+
+        try:
+            callback_id = conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _on_lifecycle, None
+            )
+        except libvirt.libvirtError:
+            callback_id = None
+    try:
+        error = _shutdown_domain(domain_name)
+        if error:
+            return error
+        if callback_id is not None:
+            # _shutdown_domain is a no-op for a domain that is already shut
+            # off or absent, and then no STOPPED event will ever fire; only
+            # block on the event when a shutdown was actually issued.
+            if _domain_state(domain_name) in ("shut off", "absent"):
+                return ""
+            if not stopped.wait(_STOP_TIMEOUT_SECONDS) and _domain_state(
+                domain_name
+            ) not in ("shut off", "absent"):
+                _destroy_domain(domain_name)
+            return ""
+    finally:
+        if callback_id is not None:
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+    # Polling fallback when no event path is available. Start with short
+    # polls so fast ACPI shutdowns are noticed within hundreds of ms, and
+    # back off towards 2s for slow guests; same overall budget and the same
+    # destroy escalation as before.
+    deadline = time.monotonic() + _STOP_TIMEOUT_SECONDS
+    delay = 0.1
+    while time.monotonic() < deadline:
+        if _domain_state(domain_name) in ("shut off", "absent"):
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    else:
+        _destroy_domain(domain_name)
+    return ""
+
+
+def _destroy_domain(domain_name: str) -> None:
+    """Best-effort hard power-off."""
+    conn = _libvirt_conn()
+    if conn is not None:
+        dom = _lookup_domain(conn, domain_name)
+        if dom is not None:
+            try:
+                dom.destroy()
+            except libvirt.libvirtError:
+                pass
+        return
+    _run_sudo(["virsh", "destroy", domain_name], timeout=60)
+
+
+def _ensure_libvirt_default_network() -> None:
+    info = _run_sudo(["virsh", "net-info", "default"], timeout=20)
+    if info.returncode != 0:
+        return
+    if "Active:         yes" not in info.stdout:
+        _run_sudo(["virsh", "net-start", "default"], timeout=30)
+        _run_sudo(["virsh", "net-autostart", "default"], timeout=30)
+
+
+_ARCH_MAP = {"amd64": "amd64", "x86_64": "amd64", "arm64": "arm64", "aarch64": "arm64"}
+_ARCH_RE = re.compile(r"(amd64|x86_64|arm64|aarch64)")
+
+
+def _normalize_arch(value: str) -> str:
+    return _ARCH_MAP.get(value.strip().lower(), "")
+
+
+def _resolve_image_architecture(image: dict[str, Any]) -> str:
+    declared = _normalize_arch(str(image.get("architecture") or ""))
+    if declared:
+        return declared
+    # One regex pass over url+name instead of four substring scans.
+    combined = f"{image.get('source_url', '')} {image.get('name', '')}".lower()
+    match = _ARCH_RE.search(combined)
+    return _ARCH_MAP[match.group(1)] if match else ""
+
+
+def _host_architecture() -> str:
+    return _normalize_arch(platform.machine()) or platform.machine().lower()
+
+
+def _compute_sha256(path: Path) -> str:
+    with path.open("rb", buffering=0) as handle:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            # Reads through a reused buffer and releases the GIL for the
+            # whole hash, letting OpenSSL's SHA extensions do the work.
+            return hashlib.file_digest(handle, "sha256").hexdigest()
+        hasher = hashlib.sha256()
+        while True:
+            chunk = handle.read(4 * 1024 * 1024)
+            if not chunk:
+                break
+            hasher.update(memoryview(chunk))
+        return hasher.hexdigest()
+
+
+def _download_cloud_image(image: dict[str, Any]) -> Path:
+    """Fetch the base cloud image into IMAGE_ROOT, verifying its checksum.
+
+    The download is streamed in 1 MiB chunks and hashed while writing, so the
+    image crosses the disk once instead of the old download/re-read/copy
+    triple pass. The temp file lives next to the destination when possible so
+    publishing is a rename; otherwise it falls back to install(1) via sudo.
+    """
+    image_path = IMAGE_ROOT / f"{image['id']}.qcow2"
+    if image_path.exists():
+        return image_path
+    _run_sudo(["mkdir", "-p", str(IMAGE_ROOT)], timeout=30)
+    expected = str(image.get("sha256") or "").strip().lower()
+    log.info("downloading cloud image %s", image["source_url"])
+    try:
+        tmp = tempfile.NamedTemporaryFile(dir=IMAGE_ROOT, suffix=".part", delete=False)
+    except OSError:
+        tmp = tempfile.NamedTemporaryFile(
+            prefix=f"lattice-image-{image['id']}-", suffix=".part", delete=False
+        )
+    tmp_path = Path(tmp.name)
+    hasher = hashlib.sha256()
+    try:
+        with tmp, request.urlopen(image["source_url"]) as response:
+            while True:
+                chunk = response.read(1 << 20)
+                if not chunk:
+                    break
+                tmp.write(chunk)
+                hasher.update(chunk)
+        if expected and hasher.hexdigest() != expected:
+            raise RuntimeError(
+                f"image checksum mismatch: expected {expected}, got {hasher.hexdigest()}"
+            )
+        if tmp_path.parent == IMAGE_ROOT:
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, image_path)
+        else:
+            result = _run_sudo(
+                ["install", "-m", "0644", str(tmp_path), str(image_path)], timeout=300
+            )
+            if result.returncode != 0:
+                raise RuntimeError(f"failed to install image: {result.stderr.strip()}")
+            tmp_path.unlink(missing_ok=True)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return image_path
+
+
+def _create_cloud_init_seed(
+    vm_dir: Path,
+    domain_name: str,
+    guest_username: str,
+    guest_password: str,
+) -> Path:
+    """Author the cloud-init NoCloud seed ISO for a new guest."""
+    seed_path = vm_dir / "seed.iso"
+    user_data = "\n".join(
+        [
+            "#cloud-config",
+            f"hostname: {domain_name}",
+            "ssh_pwauth: true",
+            "users:",
+            f"  - name: {guest_username}",
+            "    sudo: ALL=(ALL) NOPASSWD:ALL",
+            "    groups: sudo",
+            "    shell: /bin/bash",
+            "    lock_passwd: false",
+            "chpasswd:",
+            "  expire: false",
+            "  users:",
+            f"    - name: {guest_username}",
+            f"      password: {guest_password}",
+            "      type: text",
+            "",
+        ]
+    )
+    meta_data = f"instance-id: {domain_name}\nlocal-hostname: {domain_name}\n"
+    # Author the inputs in a user-writable temp dir (vm_dir is root-owned)
+    # and invoke genisoimage ourselves - cloud-localds is just a shell
+    # wrapper around it, so this skips one fork. The temp dir is removed as
+    # soon as the ISO exists: user-data holds the plaintext guest password
+    # and must not outlive the build.
+    with tempfile.TemporaryDirectory(prefix="lattice-seed-") as tmp_dir:
+        user_data_path = Path(tmp_dir) / "user-data"
+        meta_data_path = Path(tmp_dir) / "meta-data"
+        user_data_path.write_text(user_data, encoding="utf-8")
+        meta_data_path.write_text(meta_data, encoding="utf-8")
+        result = _run_sudo(
+            [
+                "genisoimage",
+                "-output",
+                str(seed_path),
+                "-volid",
+                "cidata",
+                "-joliet",
+                "-rock",
+                str(user_data_path),
+                str(meta_data_path),
+            ],
+            timeout=120,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"genisoimage failed: {result.stderr.strip()}")
+    return seed_path
+
+
+def _create_vm(command: dict[str, Any]) -> dict[str, Any]:
+    """Materialize disks and run virt-install for a vm_create command."""
+    payload = command.get("payload") or {}
+    image = payload.get("image") or {}
+    domain_name = str(payload.get("domain_name") or "").strip()
+    guest_username = str(payload.get("guest_username") or "lattice").strip()
+    guest_password = str(payload.get("guest_password") or "").strip()
+    vcpus = int(payload.get("vcpus") or 2)
+    memory_mb = int(payload.get("memory_mb") or 2048)
+    disk_gb = int(payload.get("disk_gb") or 20)
+    if not domain_name or not image:
+        return {"ok": False, "error": "vm_create payload missing domain_name or image"}
+    if not guest_password:
+        return {"ok": False, "error": "vm_create payload missing guest_password"}
+    image_arch = _resolve_image_architecture(image)
+    host_arch = _host_architecture()
+    if image_arch and image_arch != host_arch:
+        return {
+            "ok": False,
+            "error": f"image architecture {image_arch} does not match host {host_arch}",
+        }
+
+    vm_dir = VM_ROOT / domain_name
+    _run_sudo(["mkdir", "-p", str(vm_dir)], timeout=30)
+    # Seed authoring and base-image materialization are independent until
+    # virt-install needs both; running them concurrently hides the seed cost
+    # behind the (much longer) download/overlay step.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        image_future = pool.submit(_download_cloud_image, image)
+        seed_future = pool.submit(
+            _create_cloud_init_seed, vm_dir, domain_name, guest_username, guest_password
+        )
+        try:
+            base_image_path = image_future.result()
+        except Exception as exc:
+            return {"ok": False, "error": f"image download failed: {exc}"}
+
+        overlay_path = vm_dir / "disk.qcow2"
+        create = _run_sudo(
+            [
+                "qemu-img",
+                "create",
+                "-f",
+                "qcow2",
+                "-F",
+                "qcow2",
+                "-b",
+                str(base_image_path),
+                str(overlay_path),
+                f"{disk_gb}G",
+            ],
+            timeout=120,
+        )
+        if create.returncode != 0:
+            return {"ok": False, "error": f"qemu-img create failed: {create.stderr.strip()}"}
+
+        try:
+            seed_path = seed_future.result()
+        except Exception as exc:
+            return {"ok": False, "error": f"cloud-init seed failed: {exc}"}
+
+    _ensure_libvirt_default_network()
+    install = _run_sudo(
+        [
+            "virt-install",
+            "--name",
+            domain_name,
+            "--vcpus",
+            str(vcpus),
+            "--memory",
+            str(memory_mb),
+            "--disk",
+            f"path={overlay_path},format=qcow2,bus=virtio",
+            "--disk",
+            f"path={seed_path},device=cdrom",
+            "--os-variant",
+            "generic",
+            "--import",
+            "--network",
+            "network=default,model=virtio",
+            "--graphics",
+            "none",
+            "--noautoconsole",
+        ],
+        timeout=600,
+    )
+    if install.returncode != 0:
+        return {"ok": False, "error": f"virt-install failed: {install.stderr.strip()}"}
+    return {"ok": True, **_domain_snapshot(domain_name)}
+
+
+def execute_vm_command(command: dict[str, Any]) -> dict[str, Any]:
+    """Dispatch one VM command from the master and return its result payload."""
+    operation_type = str(command.get("operation_type") or "").strip()
+    domain_name = str(command.get("domain_name") or "").strip()
+
+    capability = get_vm_capability()
+    if not capability["ready"]:
+        capability = get_vm_capability(max_age_seconds=0)
+    if not capability["ready"]:
+        return {"ok": False, "error": f"vm support unavailable: {capability['reason']}"}
+
+    if operation_type == "vm_sync":
+        # Coalesce bursty syncs: everything inside a short window shares one
+        # probe instead of re-running virsh.
+        with _CAPABILITY_LOCK:
+            cached_domains = _VM_SYNC_CACHE["domains"]
+            cache_age = time.monotonic() - _VM_SYNC_CACHE["at"]
+        if cached_domains is not None and cache_age < _VM_SYNC_CACHE_SECONDS:
+            return {"ok": True, "domains": cached_domains}
+        conn = _libvirt_conn()
+        if conn is not None:
+            try:
+                domains = []
+                for dom in conn.listAllDomains(0):
+                    state, _ = dom.state()
+                    domains.append(
+                        {
+                            "name": dom.name(),
+                            "state": _LIBVIRT_STATE_MAP.get(state, "unknown"),
+                            "domain_uuid": dom.UUIDString(),
+                        }
+                    )
+            except libvirt.libvirtError as exc:
+                return {"ok": False, "error": f"libvirt list failed: {exc}"}
+            with _CAPABILITY_LOCK:
+                _VM_SYNC_CACHE["domains"] = domains
+                _VM_SYNC_CACHE["at"] = time.monotonic()
+            return {"ok": True, "domains": domains}
+        # One table listing carries every domain's name and state; one UUID
+        # listing (same order) completes the picture. That's two subprocesses
+        # total instead of 1 + 2N.
+        listing = _run_sudo(["virsh", "list", "--all"], timeout=30)
+        if listing.returncode != 0:
+            return {"ok": False, "error": f"virsh list failed: {listing.stderr.strip()}"}
+        uuid_listing = _run_sudo(["virsh", "list", "--all", "--uuid"], timeout=30)
+        uuids = (
+            [line.strip() for line in uuid_listing.stdout.splitlines() if line.strip()]
+            if uuid_listing.returncode == 0
+            else []
+        )
+        domains = []
+        for row in listing.stdout.splitlines()[2:]:  # drop table header + rule
+            parts = row.split(None, 2)
+            if len(parts) < 3:
+                continue
+            _, name, state = parts
+            domains.append(
+                {
+                    "name": name,
+                    "state": state.strip(),
+                    "domain_uuid": uuids[len(domains)] if len(domains) < len(uuids) else "",
+                }
+            )
+        with _CAPABILITY_LOCK:
+            _VM_SYNC_CACHE["domains"] = domains
+            _VM_SYNC_CACHE["at"] = time.monotonic()
+        return {"ok": True, "domains": domains}
+
+    if operation_type == "vm_create":
+        return _create_vm(command)
+
+    if not domain_name:
+        return {"ok": False, "error": "command missing domain_name"}
+
+    if operation_type == "vm_start":
+        error = _start_domain(domain_name)
+        if error:
+            return {"ok": False, "error": error}
+        return {"ok": True, **_domain_snapshot(domain_name)}
+
+    if operation_type == "vm_stop":
+        error = _stop_domain(domain_name)
+        if error:
+            return {"ok": False, "error": error}
+        snapshot = _domain_snapshot(domain_name, with_ip=False)
+        return {
+            "ok": True,
+            "state": snapshot["state"],
+            "domain_uuid": snapshot["domain_uuid"],
+            "ip_address": "",
+        }
+
+    if operation_type == "vm_reboot":
+        error = _reboot_domain(domain_name)
+        if error:
+            return {"ok": False, "error": error}
+        return {"ok": True, **_domain_snapshot(domain_name)}
+
+    if operation_type == "vm_delete":
+        _destroy_domain(domain_name)
+        # Undefine stays on virsh: --remove-all-storage is virsh-side logic
+        # with no single libvirt API equivalent.
+        undefine = _run_sudo(
+            ["virsh", "undefine", domain_name, "--nvram", "--remove-all-storage"],
+            timeout=120,
+        )
+        if undefine.returncode != 0 and not _looks_like_missing_domain_error(
+            undefine.stdout, undefine.stderr
+        ):
+            return {"ok": False, "error": f"virsh undefine failed: {undefine.stderr.strip()}"}
+        _run_sudo(["rm", "-rf", str(VM_ROOT / domain_name)], timeout=60)
+        return {"ok": True, "state": "absent", "domain_uuid": "", "ip_address": ""}
+
+    return {"ok": False, "error": f"unsupported operation_type: {operation_type}"}
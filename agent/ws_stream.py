@@ -0,0 +1,567 @@
+"""WebSocket streamer pushing logs, heartbeats, and command results to the master."""
+
+from __future__ import annotations
+
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import re
+import selectors
+import socket
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Callable
+
+import websocket
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger("lattice.agent.ws")
+
+# Outbound coalescing: drain up to this many queued events (or this many
+# rendered-JSON bytes) into one batch frame per send.
+_BATCH_MAX_EVENTS = 200
+_BATCH_MAX_BYTES = 64 * 1024
+
+# Batches at least this large go out as a deflated binary frame; smaller
+# frames skip the compression CPU cost entirely.
+_COMPRESS_MIN_BYTES = 4 * 1024
+
+# Static frames never change; render them once instead of per send.
+_PING_FRAME = '{"type":"ping"}'
+
+# Inbound frames put "type" first, so a cheap prefix sniff is enough to
+# route (or drop) most messages without a full JSON parse.
+_TYPE_RE = re.compile(r'"type"\s*:\s*"([a-z_]+)"')
+_TYPE_RE_BYTES = re.compile(rb'"type"\s*:\s*"([a-z_]+)"')
+
+# Levels that need no normalization — the overwhelmingly common case.
+_CANONICAL_LEVELS = frozenset({"debug", "info", "warning", "error", "critical"})
+
+_TERMINAL_TYPES = frozenset(
+    {
+        "terminal_open",
+        "terminal_input",
+        "terminal_resize",
+        "terminal_close",
+        "vm_terminal_open",
+        "vm_terminal_input",
+        "vm_terminal_resize",
+        "vm_terminal_close",
+    }
+)
+
+# JSON hot path: prefer orjson's C encoder/decoder when installed. Both
+# variants hand bytes to ws.send(), which websocket-client accepts for
+# text frames, skipping a decode/encode round-trip.
+if orjson is not None:
+
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+else:
+    # One preconfigured encoder instead of re-parsing options inside
+    # json.dumps per call; ensure_ascii=False keeps UTF-8 payloads at
+    # their natural size instead of \uXXXX-escaping every code point.
+    # check_circular=False: events are built fresh per call and never
+    # self-referential, so skip the recursion bookkeeping.
+    _JSON_ENCODE = json.JSONEncoder(
+        separators=(",", ":"), ensure_ascii=False, check_circular=False
+    ).encode
+
+    def _dumps(obj: Any) -> bytes:
+        return _JSON_ENCODE(obj).encode()
+
+    _loads = json.loads
+
+
+# (second, rendered "YYYY-mm-ddTHH:MM:SS" prefix) — see _utc_iso_now.
+_TS_CACHE: tuple[int, str] = (0, "")
+
+
+def _utc_iso_now() -> str:
+    """UTC ISO-8601 timestamp without a datetime object per call.
+
+    The second-resolution prefix only changes once a second, so it is
+    memoized and only the microseconds are formatted per event. A stale
+    read under concurrency just re-renders the same prefix.
+    """
+    global _TS_CACHE
+    sec, frac = divmod(time.time_ns(), 1_000_000_000)
+    cached_sec, prefix = _TS_CACHE
+    if sec != cached_sec:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+        _TS_CACHE = (sec, prefix)
+    return f"{prefix}.{frac // 1000:06d}+00:00"
+
+
+def build_agent_ws_url(master_url: str) -> str:
+    """Derive the agent WebSocket endpoint from the master's HTTP URL.
+
+    Only the scheme prefix changes and a path is appended, so plain string
+    slicing does the job without urllib.parse's full state machine.
+    """
+    url = master_url.rstrip("/")
+    if url.startswith("https://"):
+        return "wss://" + url[8:] + "/ws/agent"
+    if url.startswith("http://"):
+        return "ws://" + url[7:] + "/ws/agent"
+    return url + "/ws/agent"
+
+
+def _norm_sid(session_id: Any) -> str | None:
+    """Stripped session id, or None when unusable. Walks the string once."""
+    if type(session_id) is not str:
+        return None
+    session_id = session_id.strip()
+    return session_id or None
+
+
+def _recv_buffered(ws: Any) -> bool:
+    """True when input is already buffered above the raw file descriptor.
+
+    select() only sees the kernel socket. For wss:// the SSLSocket may hold
+    decrypted-but-unread bytes (one TLS record can carry several WebSocket
+    frames), and websocket-client keeps its own frame buffer; data parked in
+    either place never makes the fd readable again.
+    """
+    sock = getattr(ws, "sock", None)
+    pending = getattr(sock, "pending", None)
+    if pending is not None:
+        try:
+            if pending():
+                return True
+        except Exception:
+            pass
+    frame_buffer = getattr(ws, "frame_buffer", None)
+    return bool(frame_buffer is not None and getattr(frame_buffer, "recv_buffer", None))
+
+
+def _safe_module_path(module: Any) -> str:
+    try:
+        return str(getattr(module, "__file__", "<unknown>"))
+    except Exception:
+        return "<unknown>"
+
+
+def _resolve_ws_factory() -> Callable[..., Any]:
+    factory = getattr(websocket, "create_connection", None)
+    if factory is None:
+        raise RuntimeError("websocket-client is missing create_connection")
+    return factory
+
+
+# The module path never changes at runtime; resolve it once instead of on
+# every reconnect attempt.
+_WS_MODULE_PATH = _safe_module_path(websocket)
+
+
+class AgentWebSocketStreamer:
+    """Owns the agent->master WebSocket and a bounded outbound queue."""
+
+    def __init__(
+        self,
+        ws_url: str,
+        node_id: str,
+        pair_token: str,
+        queue_size: int = 1000,
+        reconnect_seconds: int = 5,
+        command_handler: Callable[[dict[str, Any]], None] | None = None,
+        terminal_handler: Callable[[dict[str, Any]], None] | None = None,
+        wire_format: str = "json",
+    ) -> None:
+        self.ws_url = ws_url
+        self.node_id = node_id
+        self.pair_token = pair_token
+        self.reconnect_seconds = max(1, reconnect_seconds)
+        self.command_handler = command_handler
+        self.terminal_handler = terminal_handler
+        # deque.append/popleft are atomic, and maxlen gives drop-oldest for
+        # free — no Condition round-trip per enqueue like queue.Queue.
+        # Producers enqueue fully rendered JSON bytes; encoding on their
+        # threads overlaps with the sender's socket writes.
+        self._deque: deque[bytes] = deque(maxlen=max(10, queue_size))
+        # session_id -> rendered frame prefix, populated by open_terminal().
+        self._terminal_prefix_cache: dict[str, bytes] = {}
+        # Events evicted by the bounded deque since the last send; reported
+        # so the master sees a gap marker instead of a silent hole.
+        self._dropped = 0
+        # Self-pipe: producers nudge the sender with one byte so it can wait
+        # on "socket readable OR queue non-empty" in a single epoll/kqueue
+        # call instead of cycling short recv timeouts.
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        # Reused by _drain_outbound so steady-state sends do not allocate a
+        # fresh buffer per frame (only the sender thread touches it).
+        self._send_buf = bytearray()
+        # Per-connection raw-deflate stream (created after auth): keeping the
+        # compressor across batches preserves its sliding-window dictionary,
+        # so repeated keys/hostnames compress far better than one-shot calls.
+        self._comp: Any = None
+        # Bounded pool instead of a fresh Thread per inbound command: caps
+        # concurrency under command bursts and amortizes thread start-up.
+        # Agents without a command handler never pay for the pool.
+        self._cmd_pool: concurrent.futures.ThreadPoolExecutor | None = None
+        if command_handler is not None:
+            self._cmd_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=8, thread_name_prefix="agent-command"
+            )
+        self._ws_factory = _resolve_ws_factory()
+        # Opt-in binary wire format: smaller frames and a faster C codec.
+        # The auth frame stays JSON so any master can read the negotiation;
+        # silently falls back to JSON when msgpack is not installed.
+        self.wire_format = (
+            "msgpack" if wire_format == "msgpack" and msgpack is not None else "json"
+        )
+        self._pack = (
+            msgpack.Packer(use_bin_type=True).pack if self.wire_format == "msgpack" else None
+        )
+        # node_id/pair_token are fixed for the process lifetime, so the auth
+        # frame can be rendered once here rather than on every reconnect.
+        auth: dict[str, Any] = {"type": "auth", "node_id": node_id, "pair_token": pair_token}
+        if self.wire_format == "msgpack":
+            auth["proto"] = "msgpack"
+        self._auth_frame = _dumps(auth)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="agent-ws", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._notify_sender()
+        if self._thread is not None:
+            self._thread.join(timeout=self.reconnect_seconds + 2)
+            self._thread = None
+        if self._cmd_pool is not None:
+            self._cmd_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _notify_sender(self) -> None:
+        try:
+            os.write(self._wake_w, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _enqueue(self, event: bytes) -> None:
+        dq = self._deque
+        if len(dq) == dq.maxlen:
+            self._dropped += 1
+        dq.append(event)
+        self._notify_sender()
+
+    def open_terminal(self, session_id: str) -> None:
+        """Cache the constant frame prefix for a terminal session so each
+        output chunk costs one string escape instead of a full dict encode."""
+        if self._pack is not None:
+            # The prefix trick is JSON-specific; msgpack sessions use _emit.
+            return
+        sid = _norm_sid(session_id)
+        if sid is not None:
+            self._terminal_prefix_cache[sid] = (
+                b'{"type":"terminal_data","session_id":' + _dumps(sid) + b',"data":'
+            )
+
+    def close_terminal(self, session_id: str) -> None:
+        # Key by the same normalized id open_terminal cached under.
+        self._terminal_prefix_cache.pop(_norm_sid(session_id), None)
+
+    def _emit(self, type_: str, fields: dict[str, Any], timestamp: bool = False) -> None:
+        """Single funnel from the public send_* wrappers into the queue.
+
+        Guards stay in the thin wrappers (they differ per type and inline
+        well); construction and enqueueing share this one code path.
+        """
+        event = dict(fields)
+        event["type"] = type_
+        if timestamp:
+            event["timestamp"] = _utc_iso_now()
+        pack = self._pack
+        self._enqueue(_dumps(event) if pack is None else pack(event))
+
+    def send_log(self, level: str, message: str, meta: dict[str, Any] | None = None) -> None:
+        if type(message) is not str or not message.strip():
+            return
+        if level not in _CANONICAL_LEVELS:
+            level = str(level or "info").strip().lower()
+        if (type(meta) is dict and meta) or self._pack is not None:
+            fields: dict[str, Any] = {"level": level, "message": message}
+            if type(meta) is dict and meta:
+                fields["meta"] = meta
+            self._emit("log", fields, timestamp=True)
+            return
+        # Fixed shape without meta: concatenate the frame directly instead
+        # of building a dict whose only purpose is to be encoded.
+        self._enqueue(
+            b'{"type":"log","level":'
+            + _dumps(level)
+            + b',"message":'
+            + _dumps(message)
+            + b',"timestamp":"'
+            + _utc_iso_now().encode()
+            + b'"}'
+        )
+
+    def send_heartbeat(self, payload: dict[str, Any]) -> None:
+        if type(payload) is not dict:
+            return
+        self._emit("heartbeat", payload, timestamp=True)
+
+    def send_command_result(self, command_id: str, status: str, detail: dict[str, Any] | None = None) -> None:
+        if type(command_id) is not str or not command_id.strip():
+            return
+        fields: dict[str, Any] = {
+            "command_id": command_id.strip(),
+            "status": str(status or "unknown"),
+        }
+        if type(detail) is dict and detail:
+            fields["detail"] = detail
+        self._emit("command_result", fields, timestamp=True)
+
+    def send_terminal_data(self, session_id: str, data: str) -> None:
+        if type(data) is not str or not data:
+            return
+        prefix = self._terminal_prefix_cache.get(session_id)
+        if prefix is not None:
+            self._enqueue(prefix + _dumps(data) + b"}")
+            return
+        sid = _norm_sid(session_id)
+        if sid is None:
+            return
+        self._emit("terminal_data", {"session_id": sid, "data": data})
+
+    def send_terminal_exit(self, session_id: str, exit_code: int) -> None:
+        sid = _norm_sid(session_id)
+        if sid is None:
+            return
+        self._emit("terminal_exit", {"session_id": sid, "exit_code": int(exit_code)})
+
+    def send_terminal_error(self, session_id: str, error: str) -> None:
+        sid = _norm_sid(session_id)
+        if sid is None:
+            return
+        self._emit("terminal_error", {"session_id": sid, "error": str(error or "unknown error")})
+
+    def _drain_outbound(self, ws: Any) -> bool:
+        """Writer half: coalesce everything immediately available into a
+        single batch frame — one send() per burst instead of one per event.
+        Ping and auth frames stay unbatched."""
+        if self._pack is not None:
+            return self._drain_outbound_msgpack(ws)
+        buf = self._send_buf
+        del buf[:]
+        buf += b'{"type":"batch","events":['
+        prefix_len = len(buf)
+        count = 0
+        dropped = self._dropped
+        if dropped:
+            self._dropped = 0
+            buf += _dumps({"type": "dropped", "count": dropped})
+            count = 1
+        # Producers only append, so a len() snapshot is a safe lower bound;
+        # bounding on it avoids raising IndexError as loop control.
+        dq = self._deque
+        pending = min(len(dq), _BATCH_MAX_EVENTS)
+        while pending > 0 and len(buf) < _BATCH_MAX_BYTES:
+            if count:
+                buf += b","
+            buf += dq.popleft()
+            count += 1
+            pending -= 1
+        if not count:
+            return False
+        if count == 1:
+            # Single event: skip the batch envelope, send the bare frame.
+            ws.send(bytes(memoryview(buf)[prefix_len:]))
+        else:
+            buf += b"]}"
+            comp = self._comp
+            if comp is not None and len(buf) >= _COMPRESS_MIN_BYTES:
+                # The master treats any binary frame as deflated batch JSON,
+                # fed through a matching per-connection decompressobj.
+                ws.send_binary(comp.compress(bytes(buf)) + comp.flush(zlib.Z_SYNC_FLUSH))
+            else:
+                ws.send(buf)
+        return True
+
+    def _drain_outbound_msgpack(self, ws: Any) -> bool:
+        """msgpack wire: concatenated packed events already form a valid
+        stream for the master's Unpacker, so no envelope, separators, or
+        app-side deflate are involved."""
+        buf = self._send_buf
+        del buf[:]
+        dropped = self._dropped
+        if dropped:
+            self._dropped = 0
+            buf += self._pack({"type": "dropped", "count": dropped})
+        dq = self._deque
+        pending = min(len(dq), _BATCH_MAX_EVENTS)
+        while pending > 0 and len(buf) < _BATCH_MAX_BYTES:
+            buf += dq.popleft()
+            pending -= 1
+        if not buf:
+            return False
+        ws.send_binary(bytes(buf))
+        return True
+
+    def _dispatch_inbound(self, inbound_raw: str | bytes) -> None:
+        """Reader half: decode one frame and route it to its handler."""
+        if not inbound_raw:
+            return
+        if isinstance(inbound_raw, bytes):
+            match = _TYPE_RE_BYTES.search(inbound_raw[:128])
+            sniffed = match.group(1).decode() if match else None
+        else:
+            match = _TYPE_RE.search(inbound_raw[:128])
+            sniffed = match.group(1) if match else None
+        if sniffed is not None:
+            # Skip the full parse for frames nobody is going to handle;
+            # an unsniffable frame falls through to the parser as before.
+            if sniffed == "command":
+                if self.command_handler is None:
+                    return
+            elif sniffed in _TERMINAL_TYPES:
+                if self.terminal_handler is None:
+                    return
+            else:
+                return
+        inbound = _loads(inbound_raw)
+        msg_type = inbound.get("type") if type(inbound) is dict else None
+        if msg_type == "command" and self.command_handler is not None:
+            self._cmd_pool.submit(self.command_handler, inbound)
+        elif msg_type in _TERMINAL_TYPES and self.terminal_handler is not None:
+            self.terminal_handler(inbound)
+
+    def _run(self) -> None:
+        backoff = float(self.reconnect_seconds)
+        while not self._stop_event.is_set():
+            ws = None
+            sel = None
+            try:
+                log.info(
+                    "connecting to %s (websocket module: %s)",
+                    self.ws_url,
+                    _WS_MODULE_PATH,
+                )
+                ws = self._ws_factory(
+                    self.ws_url,
+                    timeout=10,
+                    header=["Sec-WebSocket-Extensions:"],
+                    enable_multithread=True,
+                    # Frames are produced by our own encoders and are valid
+                    # UTF-8 by construction; without wsaccel this validation
+                    # is a pure-Python per-byte walk of every frame.
+                    skip_utf8_validation=True,
+                )
+                ws.send(self._auth_frame)
+                raw = ws.recv()
+                # The ack is a tiny fixed-schema frame with "type" first; a
+                # prefix check beats parsing it into a throwaway dict.
+                head = raw if isinstance(raw, bytes) else raw.encode() if isinstance(raw, str) else b""
+                if not head.startswith(b'{"type":"auth_ok"'):
+                    raise RuntimeError(f"ws auth failed: {raw!r}")
+                log.info("ws authenticated")
+                backoff = float(self.reconnect_seconds)
+                self._comp = zlib.compressobj(1, zlib.DEFLATED, -15)
+                sock = getattr(ws, "sock", None)
+                if sock is not None:
+                    # Batching already coalesces writes; Nagle on top of that
+                    # only adds delayed-ACK latency to each flushed frame.
+                    try:
+                        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    except OSError:
+                        pass
+                # One epoll/kqueue wait covers both wake sources; no more
+                # cycling short recv timeouts when nothing is happening.
+                sel = selectors.DefaultSelector()
+                if sock is not None:
+                    sel.register(sock, selectors.EVENT_READ, "ws")
+                sel.register(self._wake_r, selectors.EVENT_READ, "wake")
+                ws.settimeout(1)
+                last_ping_at = time.monotonic()
+                while not self._stop_event.is_set():
+                    self._drain_outbound(ws)
+                    now = time.monotonic()
+                    if now - last_ping_at >= 15:
+                        ws.send(_PING_FRAME)
+                        last_ping_at = now
+                    if self._deque:
+                        # The writer must never stall on a quiet peer.
+                        continue
+                    # Idle: the wake pipe covers new producers, so block
+                    # right up to the next ping deadline instead of a fixed
+                    # one-second tick.
+                    timeout = max(0.0, 15 - (now - last_ping_at))
+                    socket_ready = False
+                    for key, _ in sel.select(timeout=timeout):
+                        if key.data == "wake":
+                            try:
+                                os.read(self._wake_r, 4096)
+                            except (BlockingIOError, OSError):
+                                pass
+                        else:
+                            socket_ready = True
+                    if not socket_ready:
+                        continue
+                    try:
+                        inbound_raw = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    self._dispatch_inbound(inbound_raw)
+                    # Drain frames the first recv left buffered above the
+                    # fd before going back to select, which cannot see them.
+                    while _recv_buffered(ws):
+                        try:
+                            inbound_raw = ws.recv()
+                        except websocket.WebSocketTimeoutException:
+                            break
+                        self._dispatch_inbound(inbound_raw)
+            except Exception as exc:
+                log.warning("ws connection error: %s", exc)
+                # Interruptible by stop(), exponential so a down master is
+                # not hammered, jittered so a fleet does not stampede back.
+                self._stop_event.wait(timeout=backoff * random.uniform(0.8, 1.2))
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if sel is not None:
+                    try:
+                        sel.close()
+                    except Exception:
+                        pass
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+
+
+class WebSocketLogHandler(logging.Handler):
+    """Bridges stdlib logging records onto the WS streamer."""
+
+    def __init__(self, streamer: AgentWebSocketStreamer) -> None:
+        super().__init__()
+        self.streamer = streamer
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.streamer.send_log(record.levelname.lower(), self.format(record))
+        except Exception:
+            self.handleError(record)
+
@@ -0,0 +1 @@
+"""Lattice master: node registry, logs, and VM orchestration state."""
@@ -0,0 +1,1223 @@
+"""SQLite-backed state for the master: nodes, logs, VM images, VMs, operations."""
+
+from __future__ import annotations
+
+import json
+import random
+import re
+import secrets
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Iterator
+
+try:  # C-implemented JSON; a large win on heartbeat-heavy workloads.
+    import orjson
+except ImportError:  # pragma: no cover - optional accelerator
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+else:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+PAIR_CODE_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+PAIR_CODE_REGEX = re.compile(r"^[A-Z0-9]{6}$")
+VM_NAME_REGEX = re.compile(r"^[a-z0-9][a-z0-9-]{1,30}[a-z0-9]$")
+
+_ADJECTIVES = [
+    "amber",
+    "brisk",
+    "calm",
+    "dusky",
+    "eager",
+    "fuzzy",
+    "gentle",
+    "hazy",
+    "ivory",
+    "jolly",
+]
+
+_NOUNS = [
+    "aspen",
+    "brook",
+    "cedar",
+    "dune",
+    "ember",
+    "fjord",
+    "glade",
+    "harbor",
+    "inlet",
+    "juniper",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    pair_code TEXT NOT NULL UNIQUE,
+    pair_token TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'unpaired',
+    created_at TEXT NOT NULL,
+    paired_at TEXT,
+    last_heartbeat_at TEXT,
+    last_metrics_json TEXT,
+    agent_hostname TEXT,
+    agent_info_json TEXT
+);
+
+CREATE TABLE IF NOT EXISTS node_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node_id TEXT NOT NULL REFERENCES nodes(id) ON DELETE CASCADE,
+    created_at TEXT NOT NULL,
+    level TEXT NOT NULL DEFAULT 'info',
+    message TEXT NOT NULL,
+    meta_json TEXT
+);
+
+CREATE TABLE IF NOT EXISTS vm_images (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    source_url TEXT NOT NULL,
+    sha256 TEXT,
+    architecture TEXT,
+    min_disk_gb INTEGER NOT NULL DEFAULT 10,
+    enabled INTEGER NOT NULL DEFAULT 1,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS node_vms (
+    id TEXT PRIMARY KEY,
+    node_id TEXT NOT NULL REFERENCES nodes(id) ON DELETE CASCADE,
+    image_id TEXT NOT NULL REFERENCES vm_images(id),
+    name TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'provisioning',
+    vcpus INTEGER NOT NULL,
+    memory_mb INTEGER NOT NULL,
+    disk_gb INTEGER NOT NULL,
+    domain_uuid TEXT,
+    ip_address TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS vm_operations (
+    id TEXT PRIMARY KEY,
+    node_id TEXT NOT NULL REFERENCES nodes(id) ON DELETE CASCADE,
+    vm_id TEXT REFERENCES node_vms(id) ON DELETE SET NULL,
+    operation_type TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    request_json TEXT,
+    details_json TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    ended_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_nodes_pair_token ON nodes(pair_token);
+CREATE INDEX IF NOT EXISTS idx_nodes_pair_code ON nodes(pair_code);
+CREATE INDEX IF NOT EXISTS idx_node_logs_node_id_id ON node_logs(node_id, id);
+CREATE INDEX IF NOT EXISTS idx_vm_ops_vm_id ON vm_operations(vm_id);
+CREATE INDEX IF NOT EXISTS idx_node_logs_tail ON node_logs(node_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_vm_ops_vm_created_desc ON vm_operations(vm_id, created_at DESC, id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_node_vms_node_name ON node_vms(node_id, name);
+CREATE INDEX IF NOT EXISTS idx_vm_ops_status_created ON vm_operations(status, created_at);
+"""
+
+_DEFAULT_IMAGES = [
+    {
+        "id": "ubuntu-24-04-amd64",
+        "name": "Ubuntu 24.04 LTS (amd64)",
+        "source_url": "https://cloud-images.ubuntu.com/noble/current/noble-server-cloudimg-amd64.img",
+        "sha256": "",
+        "architecture": "amd64",
+        "min_disk_gb": 10,
+    },
+    {
+        "id": "debian-12-amd64",
+        "name": "Debian 12 (amd64)",
+        "source_url": "https://cloud.debian.org/images/cloud/bookworm/latest/debian-12-genericcloud-amd64.qcow2",
+        "sha256": "",
+        "architecture": "amd64",
+        "min_disk_gb": 10,
+    },
+]
+
+
+# Hot-path SQL lives in module constants so every call binds the exact same
+# string and hits sqlite3's built-in per-connection statement cache instead
+# of re-parsing the text.
+_SQL_NODE_BY_ID = "SELECT * FROM nodes WHERE id = ? LIMIT 1;"
+_SQL_HEARTBEAT_UPDATE = (
+    "UPDATE nodes SET state = 'paired', last_heartbeat_at = ?,"
+    " last_metrics_json = COALESCE(?, last_metrics_json),"
+    " agent_commit = COALESCE(?, agent_commit),"
+    " capabilities_json = COALESCE(?, capabilities_json)"
+    " WHERE id = ?;"
+)
+_SQL_LOG_INSERT = (
+    "INSERT INTO node_logs (node_id, created_at, level, message, meta_json)"
+    " VALUES (?, ?, ?, ?, ?);"
+)
+
+
+def _utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+# journal_mode persists in the database file, so flipping it to WAL is only
+# needed once per database per process; the remaining PRAGMAs are
+# per-connection state and must be reapplied.
+_WAL_DBS: set[Path] = set()
+
+
+def _connect(db_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, cached_statements=512)
+    conn.row_factory = sqlite3.Row
+    if db_path not in _WAL_DBS:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        _WAL_DBS.add(db_path)
+    conn.execute("PRAGMA foreign_keys=ON;")
+    # WAL makes synchronous=NORMAL safe (no torn pages on power loss) and
+    # skips an fsync per transaction. The rest trade a little memory for
+    # fewer temp files, page-cache misses, and read syscalls.
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA busy_timeout=30000;")
+    return conn
+
+
+# Opening a sqlite connection (and re-running the PRAGMAs) on every call is
+# measurable overhead on hot paths like heartbeats. Keep one configured
+# connection per (database, thread): WAL readers only run in parallel on
+# separate connections, and a shared connection would serialize every
+# caller on its internal mutex. Per-thread ownership also lets the sqlite3
+# module keep its thread-safety check enabled. thread-local storage (rather
+# than a module-level dict keyed by thread id) means a thread's connections
+# are released when it exits instead of accumulating for the process
+# lifetime, and no lock is needed.
+_LOCAL = threading.local()
+
+
+@contextmanager
+def _conn(db_path: Path, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """Hand out this thread's connection, run the body as one transaction.
+
+    Commits on success and rolls back on error, like the bare
+    ``with _connect(...)`` blocks it replaces. A connection that saw an
+    error is closed and dropped rather than reused.
+
+    Writers pass ``immediate=True`` to take the write lock up front with
+    BEGIN IMMEDIATE; the default deferred transaction starts as a read and
+    upgrading it mid-transaction can hit SQLITE_BUSY under concurrent load.
+    """
+    cache: dict[Path, sqlite3.Connection] | None = getattr(_LOCAL, "connections", None)
+    if cache is None:
+        cache = _LOCAL.connections = {}
+    conn = cache.get(db_path)
+    if conn is None:
+        conn = cache[db_path] = _connect(db_path)
+    try:
+        with conn:
+            if immediate:
+                conn.execute("BEGIN IMMEDIATE;")
+            yield conn
+    except Exception:
+        cache.pop(db_path, None)
+        conn.close()
+        raise
+
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> None:
+    # Reading the stored CREATE TABLE text is one sqlite_master row lookup;
+    # PRAGMA table_info re-parses the table definition on every call. The
+    # substring check is safe because no column name here is a prefix of
+    # another, and ALTER TABLE keeps the stored sql current.
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;", (table,)
+    ).fetchone()
+    create_sql = row["sql"] if row is not None else ""
+    if column not in create_sql:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {ddl};")
+
+
+def _seed_vm_images(conn: sqlite3.Connection) -> None:
+    now = _utc_now_iso()
+    conn.executemany(
+        "INSERT OR IGNORE INTO vm_images (id, name, source_url, sha256, architecture, min_disk_gb, enabled, created_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, 1, ?);",
+        [
+            (
+                image["id"],
+                image["name"],
+                image["source_url"],
+                image["sha256"],
+                image["architecture"],
+                image["min_disk_gb"],
+                now,
+            )
+            for image in _DEFAULT_IMAGES
+        ],
+    )
+
+
+# Bump whenever _SCHEMA or the _ensure_column migrations below change, so
+# existing databases run the migration block exactly once.
+_SCHEMA_VERSION = 2
+
+
+def init_db(db_path: Path) -> None:
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    with _conn(db_path) as conn:
+        if conn.execute("PRAGMA user_version;").fetchone()[0] >= _SCHEMA_VERSION:
+            return
+        conn.executescript(_SCHEMA)
+        # executescript leaves the connection in autocommit; group the
+        # migrations, seeding, and version stamp under one fsync.
+        conn.execute("BEGIN IMMEDIATE;")
+        _ensure_column(conn, "nodes", "agent_commit", "agent_commit TEXT")
+        _ensure_column(conn, "nodes", "capabilities_json", "capabilities_json TEXT")
+        _ensure_column(conn, "node_vms", "guest_username", "guest_username TEXT")
+        _seed_vm_images(conn)
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION};")
+
+
+def is_valid_pair_code(value: str) -> bool:
+    if not isinstance(value, str):
+        return False
+    # Already-normalized input (the common case) never touches the regex
+    # engine or the strip/upper allocations; these are single-pass C scans.
+    if len(value) == 6 and value.isascii() and value.isalnum() and value.isupper():
+        return True
+    return bool(PAIR_CODE_REGEX.fullmatch(value.strip().upper()))
+
+
+def _generate_friendly_name(conn: sqlite3.Connection) -> str:
+    base = f"{random.choice(_ADJECTIVES)}-{random.choice(_NOUNS)}"
+    existing = conn.execute(
+        "SELECT 1 FROM nodes WHERE name = ? LIMIT 1;", (base,)
+    ).fetchone()
+    if existing is None:
+        return base
+    # One prefix scan for every name derived from this base, then pick the
+    # smallest free suffix locally instead of probing one SELECT per suffix.
+    taken = {
+        row["name"]
+        for row in conn.execute(
+            "SELECT name FROM nodes WHERE name LIKE ?;", (f"{base}-%",)
+        )
+    }
+    suffix = 2
+    while f"{base}-{suffix}" in taken:
+        suffix += 1
+    return f"{base}-{suffix}"
+
+
+def _random_pair_code() -> str:
+    # One urandom read instead of six secrets.choice calls. The modulo fold
+    # onto 36 symbols has a bias well under 1% — fine for a display code.
+    return "".join(PAIR_CODE_ALPHABET[b % 36] for b in secrets.token_bytes(6))
+
+
+def _generate_unique_pair_code(conn: sqlite3.Connection) -> str:
+    # Check a batch of candidates per round trip rather than one SELECT each.
+    for _ in range(8):
+        candidates = [_random_pair_code() for _ in range(8)]
+        taken = {
+            row["pair_code"]
+            for row in conn.execute(
+                "SELECT pair_code FROM nodes WHERE pair_code IN (?, ?, ?, ?, ?, ?, ?, ?);",
+                candidates,
+            )
+        }
+        for code in candidates:
+            if code not in taken:
+                return code
+    raise RuntimeError("could not generate a unique pair code")
+
+
+def _safe_json_loads(raw: Any) -> Any:
+    if not raw:
+        return None
+    if not isinstance(raw, (str, bytes)):
+        return None
+    try:
+        return _json_loads(raw)
+    except (ValueError, TypeError):
+        return None
+
+
+@lru_cache(maxsize=1024)
+def _parse_json_cached(raw: str) -> Any:
+    """Parse-once cache for JSON columns that rarely change between reads.
+
+    Capabilities and agent info are rewritten only on pairing or capability
+    changes, yet re-parsed on every node read; keying on the raw string
+    makes repeat parses a dict lookup. Not for last_metrics_json, which
+    changes every heartbeat and would only churn the cache.
+    """
+    try:
+        return _json_loads(raw)
+    except (ValueError, TypeError):
+        return None
+
+
+# Accepted heartbeat metrics, split by normalization rule. New metrics only
+# need a key added here rather than another branch in the function below.
+_PCT_KEYS = ("cpu_percent", "memory_percent", "disk_percent")
+_U64_KEYS = (
+    "memory_used_bytes",
+    "memory_total_bytes",
+    "disk_used_bytes",
+    "disk_total_bytes",
+)
+
+
+def _normalize_runtime_metrics(value: Any) -> dict[str, Any] | None:
+    if not isinstance(value, dict):
+        return None
+    metrics: dict[str, Any] = {}
+    for key in _PCT_KEYS:
+        pct = value.get(key)
+        if isinstance(pct, (int, float)):
+            metrics[key] = max(0.0, min(100.0, round(float(pct), 2)))
+    for key in _U64_KEYS:
+        count = value.get(key)
+        if isinstance(count, int) and count >= 0:
+            metrics[key] = count
+    return metrics or None
+
+
+# Columns copied into public payloads verbatim. Building the dict from these
+# skips the copy-then-pop dance (each pop is a hash lookup plus a delete) that
+# the old dict(row) approach paid per row.
+_NODE_FIELDS = (
+    "id",
+    "name",
+    "pair_code",
+    "state",
+    "created_at",
+    "paired_at",
+    "last_heartbeat_at",
+    "agent_hostname",
+    "agent_commit",
+)
+
+_LOG_FIELDS = ("id", "node_id", "created_at", "level", "message")
+
+
+def _to_public_node(row: sqlite3.Row | dict[str, Any]) -> dict[str, Any]:
+    payload = {key: row[key] for key in _NODE_FIELDS}
+    raw_agent_info = row["agent_info_json"]
+    raw_capabilities = row["capabilities_json"]
+    payload["agent_info"] = (
+        _parse_json_cached(raw_agent_info) if isinstance(raw_agent_info, str) and raw_agent_info else None
+    )
+    payload["last_metrics"] = _safe_json_loads(row["last_metrics_json"])
+    payload["capabilities"] = (
+        _parse_json_cached(raw_capabilities) if isinstance(raw_capabilities, str) and raw_capabilities else None
+    )
+    return payload
+
+
+def _to_public_log(row: sqlite3.Row) -> dict[str, Any]:
+    payload = {key: row[key] for key in _LOG_FIELDS}
+    payload["meta"] = _safe_json_loads(row["meta_json"])
+    return payload
+
+
+def _insert_node_log(
+    conn: sqlite3.Connection,
+    node_id: str,
+    level: str,
+    message: str,
+    meta: dict[str, Any] | None = None,
+) -> None:
+    conn.execute(
+        _SQL_LOG_INSERT,
+        (
+            node_id,
+            _utc_now_iso(),
+            level,
+            message,
+            _json_dumps(meta) if meta else None,
+        ),
+    )
+
+
+def create_node(db_path: Path) -> dict[str, Any]:
+    node_id = secrets.token_hex(16)
+    with _conn(db_path, immediate=True) as conn:
+        name = _generate_friendly_name(conn)
+        pair_code = _generate_unique_pair_code(conn)
+        pair_token = secrets.token_urlsafe(32)
+        now = _utc_now_iso()
+        conn.execute(
+            "INSERT INTO nodes (id, name, pair_code, pair_token, state, created_at)"
+            " VALUES (?, ?, ?, ?, 'unpaired', ?);",
+            (node_id, name, pair_code, pair_token, now),
+        )
+        _insert_node_log(conn, node_id, "info", f"node {name} created")
+    # The full row is known from the INSERT values; no need to read it back.
+    return _to_public_node(
+        {
+            "id": node_id,
+            "name": name,
+            "pair_code": pair_code,
+            "pair_token": pair_token,
+            "state": "unpaired",
+            "created_at": now,
+            "paired_at": None,
+            "last_heartbeat_at": None,
+            "last_metrics_json": None,
+            "agent_hostname": None,
+            "agent_info_json": None,
+            "agent_commit": None,
+            "capabilities_json": None,
+        }
+    )
+
+
+def get_node_by_id(db_path: Path, node_id: str) -> dict[str, Any] | None:
+    with _conn(db_path) as conn:
+        row = conn.execute(_SQL_NODE_BY_ID, (node_id,)).fetchone()
+    if row is None:
+        return None
+    return _to_public_node(row)
+
+
+def get_node_pair_token(db_path: Path, node_id: str) -> str | None:
+    with _conn(db_path) as conn:
+        row = conn.execute(
+            "SELECT pair_token FROM nodes WHERE id = ? LIMIT 1;", (node_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return row["pair_token"]
+
+
+def list_nodes(db_path: Path, include: set[str] | None = None) -> list[dict[str, Any]]:
+    """List nodes, projecting only the JSON blobs the caller asked for.
+
+    ``include`` may contain "agent_info", "metrics", and "capabilities";
+    anything left out is neither read off disk nor parsed and comes back as
+    None. The default covers what the node overview renders.
+    """
+    wanted = {"metrics", "capabilities"} if include is None else include
+    columns = list(_NODE_FIELDS)
+    if "agent_info" in wanted:
+        columns.append("agent_info_json")
+    if "metrics" in wanted:
+        columns.append("last_metrics_json")
+    if "capabilities" in wanted:
+        columns.append("capabilities_json")
+    sql = f"SELECT {', '.join(columns)} FROM nodes ORDER BY created_at DESC;"
+    with _conn(db_path) as conn:
+        rows = conn.execute(sql).fetchall()
+    payloads = []
+    for row in rows:
+        payload = {key: row[key] for key in _NODE_FIELDS}
+        raw_agent_info = row["agent_info_json"] if "agent_info" in wanted else None
+        raw_capabilities = row["capabilities_json"] if "capabilities" in wanted else None
+        payload["agent_info"] = (
+            _parse_json_cached(raw_agent_info) if isinstance(raw_agent_info, str) and raw_agent_info else None
+        )
+        payload["last_metrics"] = (
+            _safe_json_loads(row["last_metrics_json"]) if "metrics" in wanted else None
+        )
+        payload["capabilities"] = (
+            _parse_json_cached(raw_capabilities) if isinstance(raw_capabilities, str) and raw_capabilities else None
+        )
+        payloads.append(payload)
+    return payloads
+
+
+def pair_node(db_path: Path, pair_code: str, agent_info: Any) -> dict[str, Any] | None:
+    if not is_valid_pair_code(pair_code):
+        return None
+    clean_code = pair_code.strip().upper()
+    hostname = ""
+    if isinstance(agent_info, dict):
+        hostname = str(agent_info.get("hostname") or "")
+    with _conn(db_path, immediate=True) as conn:
+        row = conn.execute(
+            "SELECT * FROM nodes WHERE pair_code = ? LIMIT 1;", (clean_code,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = _utc_now_iso()
+        agent_info_json = _json_dumps(agent_info) if isinstance(agent_info, dict) else None
+        conn.execute(
+            "UPDATE nodes SET state = 'paired', paired_at = ?, agent_hostname = ?,"
+            " agent_info_json = ? WHERE id = ?;",
+            (now, hostname, agent_info_json, row["id"]),
+        )
+        _insert_node_log(conn, row["id"], "info", f"agent paired from {hostname or 'unknown host'}")
+    updated = dict(row)
+    updated["state"] = "paired"
+    updated["paired_at"] = now
+    updated["agent_hostname"] = hostname
+    updated["agent_info_json"] = agent_info_json
+    payload = _to_public_node(updated)
+    payload["pair_token"] = row["pair_token"]
+    return payload
+
+
+def record_heartbeat(
+    db_path: Path,
+    node_id: str,
+    pair_token: str,
+    runtime_metrics: Any = None,
+    agent_commit: str | None = None,
+    vm_capability: Any = None,
+) -> dict[str, Any] | None:
+    with _conn(db_path, immediate=True) as conn:
+        row = conn.execute(_SQL_NODE_BY_ID, (node_id,)).fetchone()
+        if row is None or row["pair_token"] != pair_token:
+            return None
+        now = _utc_now_iso()
+        metrics = _normalize_runtime_metrics(runtime_metrics)
+        metrics_json = _json_dumps(metrics) if metrics else None
+        capabilities_json = (
+            _json_dumps({"vm": vm_capability}) if vm_capability is not None else None
+        )
+        conn.execute(
+            _SQL_HEARTBEAT_UPDATE,
+            (now, metrics_json, agent_commit, capabilities_json, node_id),
+        )
+        _insert_node_log(conn, node_id, "debug", "heartbeat received")
+    # Every updated value is already in hand, so overlay them on the row we
+    # read instead of re-SELECTing it (mirrors the COALESCE semantics above).
+    updated = dict(row)
+    updated["state"] = "paired"
+    updated["last_heartbeat_at"] = now
+    if metrics_json is not None:
+        updated["last_metrics_json"] = metrics_json
+    if agent_commit is not None:
+        updated["agent_commit"] = agent_commit
+    if capabilities_json is not None:
+        updated["capabilities_json"] = capabilities_json
+    return _to_public_node(updated)
+
+
+def rename_node(db_path: Path, node_id: str, new_name: str) -> dict[str, Any] | None:
+    clean_name = str(new_name or "").strip()
+    if not clean_name:
+        return None
+    with _conn(db_path, immediate=True) as conn:
+        row = conn.execute(_SQL_NODE_BY_ID, (node_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE nodes SET name = ? WHERE id = ?;", (clean_name, node_id)
+        )
+        _insert_node_log(conn, node_id, "info", f"node renamed to {clean_name}")
+    updated = dict(row)
+    updated["name"] = clean_name
+    return _to_public_node(updated)
+
+
+def delete_node(db_path: Path, node_id: str) -> bool:
+    with _conn(db_path, immediate=True) as conn:
+        cursor = conn.execute("DELETE FROM nodes WHERE id = ?;", (node_id,))
+    return cursor.rowcount > 0
+
+
+def append_node_log(
+    db_path: Path,
+    node_id: str,
+    pair_token: str,
+    level: str,
+    message: str,
+    meta: dict[str, Any] | None = None,
+) -> bool:
+    clean_message = str(message or "").strip()
+    if not clean_message:
+        return False
+    clean_level = str(level or "info").strip().lower()
+    if clean_level not in ("debug", "info", "warning", "error", "critical"):
+        clean_level = "info"
+    with _conn(db_path, immediate=True) as conn:
+        row = conn.execute(
+            "SELECT pair_token FROM nodes WHERE id = ? LIMIT 1;", (node_id,)
+        ).fetchone()
+        if row is None or row["pair_token"] != pair_token:
+            return False
+        _insert_node_log(conn, node_id, clean_level, clean_message, meta)
+    return True
+
+
+def list_node_logs(
+    db_path: Path,
+    node_id: str,
+    limit: int = 200,
+    since_id: int | None = None,
+) -> list[dict[str, Any]]:
+    clean_limit = max(1, min(500, int(limit)))
+    with _conn(db_path) as conn:
+        if since_id is not None:
+            rows = conn.execute(
+                "SELECT * FROM node_logs WHERE node_id = ? AND id > ?"
+                " ORDER BY id ASC LIMIT ?;",
+                (node_id, since_id, clean_limit),
+            ).fetchall()
+            return [_to_public_log(row) for row in rows]
+        # Let SQL reorder the tail instead of materializing a reversed copy.
+        rows = conn.execute(
+            "SELECT * FROM (SELECT * FROM node_logs WHERE node_id = ?"
+            " ORDER BY id DESC LIMIT ?) ORDER BY id ASC;",
+            (node_id, clean_limit),
+        ).fetchall()
+    return [_to_public_log(row) for row in rows]
+
+
+# --- VM orchestration -------------------------------------------------------
+
+
+def list_vm_images(db_path: Path) -> list[dict[str, Any]]:
+    with _conn(db_path) as conn:
+        rows = conn.execute(
+            "SELECT * FROM vm_images WHERE enabled = 1 ORDER BY name ASC;"
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+# json_extract pulls the one flag out of capabilities_json in C, with no
+# Python-side parse of the whole blob.
+_SQL_NODE_VM_READY = (
+    "SELECT state, json_extract(capabilities_json, '$.vm.ready') AS vm_ready"
+    " FROM nodes WHERE id = ? LIMIT 1;"
+)
+
+
+def _parse_vm_create_payload(payload: Any) -> tuple[dict[str, Any] | None, str]:
+    if not isinstance(payload, dict):
+        return None, "payload must be an object"
+    name = str(payload.get("name") or "").strip().lower()
+    # Cheap length check first; the regex only runs on plausible names.
+    if not 3 <= len(name) <= 32 or not VM_NAME_REGEX.fullmatch(name):
+        return None, "invalid vm name"
+    image_id = str(payload.get("image_id") or "").strip()
+    if not image_id:
+        return None, "image_id is required"
+    try:
+        vcpus = int(payload.get("vcpus") or 2)
+        memory_mb = int(payload.get("memory_mb") or 2048)
+        disk_gb = int(payload.get("disk_gb") or 20)
+    except (TypeError, ValueError):
+        return None, "vcpus, memory_mb, and disk_gb must be integers"
+    if not (1 <= vcpus <= 64):
+        return None, "vcpus out of range"
+    if not (256 <= memory_mb <= 262144):
+        return None, "memory_mb out of range"
+    if not (5 <= disk_gb <= 2048):
+        return None, "disk_gb out of range"
+    guest_username = str(payload.get("guest_username") or "lattice").strip()
+    guest_password = str(payload.get("guest_password") or "").strip()
+    if not guest_password:
+        return None, "guest_password is required"
+    return (
+        {
+            "name": name,
+            "image_id": image_id,
+            "vcpus": vcpus,
+            "memory_mb": memory_mb,
+            "disk_gb": disk_gb,
+            "guest_username": guest_username,
+            "guest_password": guest_password,
+        },
+        "",
+    )
+
+
+_SQL_VM_OP_BY_ID = (
+    "SELECT id, node_id, vm_id, operation_type, status, request_json,"
+    " details_json, error, created_at, started_at, ended_at"
+    " FROM vm_operations WHERE id = ? LIMIT 1;"
+)
+_SQL_NODE_EXISTS = "SELECT 1 FROM nodes WHERE id = ? LIMIT 1;"
+_SQL_VM_OP_INSERT = (
+    "INSERT INTO vm_operations (id, node_id, vm_id, operation_type, status,"
+    " request_json, created_at)"
+    " VALUES (?, ?, ?, ?, 'queued', ?, ?);"
+)
+_SQL_VM_PENDING_OP_PROBE = (
+    "SELECT 1 FROM vm_operations WHERE vm_id = ? AND status IN ('queued', 'running')"
+    " LIMIT 1;"
+)
+_SQL_IMAGE_ENABLED_BY_ID = "SELECT * FROM vm_images WHERE id = ? AND enabled = 1 LIMIT 1;"
+_SQL_VM_BY_ID = "SELECT * FROM node_vms WHERE id = ? LIMIT 1;"
+_SQL_NODE_VM_BY_ID = "SELECT * FROM node_vms WHERE id = ? AND node_id = ? LIMIT 1;"
+_SQL_IMAGE_NAME_BY_ID = "SELECT name FROM vm_images WHERE id = ? LIMIT 1;"
+
+# Image names never change after seeding, so single-VM lookups skip the
+# vm_images JOIN and resolve the name through this cache instead; only the
+# first lookup per (db, image) ever touches the table.
+_IMAGE_NAMES: dict[tuple[Path, str], str] = {}
+
+
+def _image_name(conn: sqlite3.Connection, db_path: Path, image_id: str) -> str | None:
+    key = (db_path, image_id)
+    name = _IMAGE_NAMES.get(key)
+    if name is None:
+        row = conn.execute(_SQL_IMAGE_NAME_BY_ID, (image_id,)).fetchone()
+        if row is None:
+            return None
+        name = row["name"]
+        _IMAGE_NAMES[key] = name
+    return name
+
+# One query for a node's VMs plus each VM's most recent operation, instead
+# of one operation lookup per VM (N+1). The window numbers operations per VM
+# newest-first; rn = 1 keeps only the latest.
+_SQL_NODE_VMS_WITH_LAST_OP = (
+    "SELECT nv.*, vi.name AS image_name,"
+    " lo.id AS op_id, lo.node_id AS op_node_id,"
+    " lo.operation_type AS op_operation_type, lo.status AS op_status,"
+    " lo.request_json AS op_request_json, lo.details_json AS op_details_json,"
+    " lo.error AS op_error, lo.created_at AS op_created_at,"
+    " lo.started_at AS op_started_at, lo.ended_at AS op_ended_at"
+    " FROM node_vms nv"
+    " INNER JOIN vm_images vi ON vi.id = nv.image_id"
+    " LEFT JOIN (SELECT *, ROW_NUMBER() OVER"
+    " (PARTITION BY vm_id ORDER BY created_at DESC) AS rn FROM vm_operations) lo"
+    " ON lo.vm_id = nv.id AND lo.rn = 1"
+    " WHERE nv.node_id = ? ORDER BY nv.created_at DESC;"
+)
+
+
+def _pop_joined_vm_operation(row_dict: dict[str, Any]) -> dict[str, Any] | None:
+    """Strip the op_* columns of a joined VM row into a public operation."""
+    operation = {
+        "id": row_dict.pop("op_id"),
+        "node_id": row_dict.pop("op_node_id"),
+        "vm_id": row_dict["id"],
+        "operation_type": row_dict.pop("op_operation_type"),
+        "status": row_dict.pop("op_status"),
+        "request_json": row_dict.pop("op_request_json"),
+        "details_json": row_dict.pop("op_details_json"),
+        "error": row_dict.pop("op_error"),
+        "created_at": row_dict.pop("op_created_at"),
+        "started_at": row_dict.pop("op_started_at"),
+        "ended_at": row_dict.pop("op_ended_at"),
+    }
+    if operation["id"] is None:
+        return None
+    return _to_public_vm_operation(operation)
+
+
+def _fetch_latest_vm_operation(conn: sqlite3.Connection, vm_id: str) -> dict[str, Any] | None:
+    row = conn.execute(
+        "SELECT * FROM vm_operations WHERE vm_id = ?"
+        " ORDER BY created_at DESC LIMIT 1;",
+        (vm_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    return _to_public_vm_operation(row)
+
+
+def _to_public_vm_operation(row: sqlite3.Row | dict[str, Any]) -> dict[str, Any]:
+    payload = dict(row)
+    raw_request = payload.pop("request_json", None)
+    raw_details = payload.pop("details_json", None)
+    payload["request"] = _safe_json_loads(raw_request)
+    payload["details"] = _safe_json_loads(raw_details)
+    return payload
+
+
+def _to_public_vm(row: sqlite3.Row | dict[str, Any]) -> dict[str, Any]:
+    payload = dict(row)
+    payload.pop("guest_password", None)
+    # Callers attach an already-parsed last_operation dict when they have one;
+    # serializing it to JSON just so this function can parse it again would be
+    # pure overhead.
+    payload.setdefault("last_operation", None)
+    return payload
+
+
+def create_vm_request(
+    db_path: Path,
+    node_id: str,
+    payload: Any,
+) -> tuple[str, dict[str, Any] | None]:
+    """Validate and queue a vm_create operation. Returns (status, payload)."""
+    normalized, error = _parse_vm_create_payload(payload)
+    if normalized is None:
+        return "invalid", {"error": error}
+    with _conn(db_path, immediate=True) as conn:
+        node_row = conn.execute(_SQL_NODE_VM_READY, (node_id,)).fetchone()
+        if node_row is None:
+            return "missing_node", None
+        if node_row["state"] != "paired":
+            return "node_not_paired", None
+        if not node_row["vm_ready"]:
+            return "node_not_ready", None
+        image_row = conn.execute(
+            _SQL_IMAGE_ENABLED_BY_ID, (normalized["image_id"],)
+        ).fetchone()
+        if image_row is None:
+            return "missing_image", None
+        if normalized["disk_gb"] < image_row["min_disk_gb"]:
+            return "invalid", {"error": f"disk_gb must be at least {image_row['min_disk_gb']}"}
+        vm_id = secrets.token_hex(16)
+        op_id = secrets.token_hex(16)
+        now = _utc_now_iso()
+        # The unique (node_id, name) index lets the INSERT detect a name
+        # clash atomically — no pre-SELECT, and no race window between the
+        # check and the write under concurrent creates.
+        inserted = conn.execute(
+            "INSERT INTO node_vms (id, node_id, image_id, name, state, vcpus, memory_mb,"
+            " disk_gb, guest_username, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, 'provisioning', ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(node_id, name) DO NOTHING RETURNING *;",
+            (
+                vm_id,
+                node_id,
+                normalized["image_id"],
+                normalized["name"],
+                normalized["vcpus"],
+                normalized["memory_mb"],
+                normalized["disk_gb"],
+                normalized["guest_username"],
+                now,
+                now,
+            ),
+        ).fetchone()
+        if inserted is None:
+            return "conflict", {"error": "vm name already in use on this node"}
+        redacted_request = dict(normalized)
+        redacted_request["guest_password"] = "***"
+        conn.execute(
+            _SQL_VM_OP_INSERT,
+            (op_id, node_id, vm_id, "vm_create", _json_dumps(redacted_request), now),
+        )
+        _insert_node_log(
+            conn,
+            node_id,
+            "info",
+            f"vm create queued: {normalized['name']}",
+            {"vm_id": vm_id, "operation_id": op_id, "request": redacted_request},
+        )
+    # RETURNING hands back the inserted row, and the image row is already in
+    # memory, so both payloads come together without a re-SELECT.
+    vm_row = dict(inserted)
+    vm_row["image_name"] = image_row["name"]
+    result = _to_public_vm(vm_row)
+    result["pending_operation"] = {
+        "id": op_id,
+        "node_id": node_id,
+        "vm_id": vm_id,
+        "operation_type": "vm_create",
+        "status": "queued",
+        "error": None,
+        "created_at": now,
+        "started_at": None,
+        "ended_at": None,
+        "request": redacted_request,
+        "details": None,
+    }
+    return "ok", result
+
+
+def queue_vm_action(
+    db_path: Path,
+    node_id: str,
+    vm_id: str,
+    action: str,
+) -> tuple[str, dict[str, Any] | None]:
+    """Queue start/stop/reboot/delete for an existing VM. Returns (status, payload)."""
+    clean_action = str(action or "").strip().lower()
+    operation_type = {
+        "start": "vm_start",
+        "stop": "vm_stop",
+        "reboot": "vm_reboot",
+        "delete": "vm_delete",
+    }.get(clean_action)
+    if operation_type is None:
+        return "invalid", {"error": f"unsupported action: {action}"}
+    with _conn(db_path, immediate=True) as conn:
+        # Existence probe only; no point materializing the whole node row.
+        if conn.execute(_SQL_NODE_EXISTS, (node_id,)).fetchone() is None:
+            return "missing_node", None
+        vm_row = conn.execute(
+            _SQL_NODE_VM_BY_ID,
+            (vm_id, node_id),
+        ).fetchone()
+        if vm_row is None:
+            return "missing_vm", None
+        vm_dict = dict(vm_row)
+        vm_dict["image_name"] = _image_name(conn, db_path, vm_dict["image_id"])
+        pending = conn.execute(_SQL_VM_PENDING_OP_PROBE, (vm_id,)).fetchone()
+        if pending is not None:
+            return "busy", {"error": "an operation is already pending for this vm"}
+        op_id = secrets.token_hex(16)
+        now = _utc_now_iso()
+        vm_name = vm_dict["name"]
+        request_payload = {"action": clean_action, "domain_name": vm_name}
+        # Both values are drawn from validated sets (fixed action names, the
+        # VM name regex), so the stored JSON can be templated directly with
+        # no serializer pass.
+        request_json = f'{{"action": "{clean_action}", "domain_name": "{vm_name}"}}'
+        conn.execute(
+            _SQL_VM_OP_INSERT,
+            (op_id, node_id, vm_id, operation_type, request_json, now),
+        )
+        _insert_node_log(
+            conn,
+            node_id,
+            "info",
+            f"vm {clean_action} queued for {vm_name}",
+            {"vm_id": vm_id, "operation_id": op_id},
+        )
+    # Queuing an operation does not touch the VM row, so the row fetched for
+    # validation is still current; the operation payload is the insert values.
+    result = _to_public_vm(vm_dict)
+    result["pending_operation"] = {
+        "id": op_id,
+        "node_id": node_id,
+        "vm_id": vm_id,
+        "operation_type": operation_type,
+        "status": "queued",
+        "error": None,
+        "created_at": now,
+        "started_at": None,
+        "ended_at": None,
+        "request": request_payload,
+        "details": None,
+    }
+    return "ok", result
+
+
+def list_node_vms(db_path: Path, node_id: str) -> list[dict[str, Any]]:
+    with _conn(db_path) as conn:
+        rows = conn.execute(_SQL_NODE_VMS_WITH_LAST_OP, (node_id,)).fetchall()
+    payloads = []
+    for row in rows:
+        row_dict = dict(row)
+        row_dict["last_operation"] = _pop_joined_vm_operation(row_dict)
+        payloads.append(_to_public_vm(row_dict))
+    return payloads
+
+
+def get_node_vm(db_path: Path, node_id: str, vm_id: str) -> dict[str, Any] | None:
+    with _conn(db_path) as conn:
+        row = conn.execute(
+            _SQL_NODE_VM_BY_ID,
+            (vm_id, node_id),
+        ).fetchone()
+        if row is None:
+            return None
+        row_dict = dict(row)
+        row_dict["image_name"] = _image_name(conn, db_path, row_dict["image_id"])
+        row_dict["last_operation"] = _fetch_latest_vm_operation(conn, vm_id)
+    return _to_public_vm(row_dict)
+
+
+def claim_queued_vm_operations(db_path: Path, node_id: str, limit: int = 4) -> list[dict[str, Any]]:
+    """Mark up to `limit` queued operations as running and hand them to the agent."""
+    clean_limit = max(1, min(16, int(limit)))
+    claimed: list[dict[str, Any]] = []
+    with _conn(db_path, immediate=True) as conn:
+        rows = conn.execute(
+            "SELECT * FROM vm_operations WHERE node_id = ? AND status = 'queued'"
+            " ORDER BY created_at ASC LIMIT ?;",
+            (node_id, clean_limit),
+        ).fetchall()
+        now = _utc_now_iso()
+        for row in rows:
+            conn.execute(
+                "UPDATE vm_operations SET status = 'running', started_at = ? WHERE id = ?;",
+                (now, row["id"]),
+            )
+            payload = _to_public_vm_operation(row)
+            payload["status"] = "running"
+            payload["started_at"] = now
+            claimed.append(payload)
+    return claimed
+
+
+def apply_vm_command_result(
+    db_path: Path,
+    node_id: str,
+    operation_id: str,
+    ok: bool,
+    message: str = "",
+    details: Any = None,
+) -> tuple[str, dict[str, Any] | None]:
+    """Record the agent's result for an operation and roll VM state forward."""
+    clean_message = str(message or "").strip()
+    details_payload = details if isinstance(details, dict) else None
+    error = None
+    with _conn(db_path, immediate=True) as conn:
+        op_row = conn.execute(
+            _SQL_VM_OP_BY_ID, (operation_id,)
+        ).fetchone()
+        if op_row is None or op_row["node_id"] != node_id:
+            return "missing_operation", None
+        if op_row["status"] not in ("queued", "running"):
+            return "already_finished", None
+        now = _utc_now_iso()
+        final_status = "succeeded" if ok else "failed"
+        if not ok:
+            error = clean_message or "operation failed"
+        conn.execute(
+            "UPDATE vm_operations SET status = ?, error = ?, details_json = ?,"
+            " started_at = COALESCE(started_at, ?), ended_at = ? WHERE id = ?;",
+            (
+                final_status,
+                error,
+                _json_dumps(details_payload) if details_payload else None,
+                now,
+                now,
+                operation_id,
+            ),
+        )
+        refreshed_vm = None
+        if op_row["vm_id"]:
+            vm_row = conn.execute(
+                _SQL_VM_BY_ID, (op_row["vm_id"],)
+            ).fetchone()
+            if vm_row is not None:
+                if ok and op_row["operation_type"] == "vm_delete":
+                    conn.execute(
+                        "DELETE FROM node_vms WHERE id = ?;", (op_row["vm_id"],)
+                    )
+                else:
+                    new_state = vm_row["state"]
+                    if ok:
+                        new_state = {
+                            "vm_create": "running",
+                            "vm_start": "running",
+                            "vm_reboot": "running",
+                            "vm_stop": "stopped",
+                        }.get(op_row["operation_type"], vm_row["state"])
+                    elif op_row["operation_type"] == "vm_create":
+                        new_state = "error"
+                    domain_uuid = vm_row["domain_uuid"]
+                    ip_address = vm_row["ip_address"]
+                    if isinstance(details_payload, dict):
+                        domain_uuid = details_payload.get("domain_uuid") or domain_uuid
+                        ip_address = details_payload.get("ip_address") or ip_address
+                    conn.execute(
+                        "UPDATE node_vms SET state = ?, domain_uuid = ?, ip_address = ?,"
+                        " updated_at = ? WHERE id = ?;",
+                        (new_state, domain_uuid, ip_address, now, op_row["vm_id"]),
+                    )
+                    # Patch the row read for validation rather than re-SELECT:
+                    # every changed column is known in-process.
+                    refreshed_vm = dict(vm_row)
+                    refreshed_vm["image_name"] = _image_name(
+                        conn, db_path, vm_row["image_id"]
+                    )
+                    refreshed_vm["state"] = new_state
+                    refreshed_vm["domain_uuid"] = domain_uuid
+                    refreshed_vm["ip_address"] = ip_address
+                    refreshed_vm["updated_at"] = now
+        _insert_node_log(
+            conn,
+            node_id,
+            "info" if ok else "error",
+            f"vm operation {op_row['operation_type']} {final_status}"
+            + (f": {clean_message}" if clean_message else ""),
+            {"operation_id": operation_id, "vm_id": op_row["vm_id"]},
+        )
+    # Same idea for the operation payload: overlay the UPDATE values on the
+    # row instead of re-reading it.
+    operation = _to_public_vm_operation(op_row)
+    operation["status"] = final_status
+    operation["error"] = error
+    operation["details"] = details_payload
+    operation["started_at"] = operation["started_at"] or now
+    operation["ended_at"] = now
+    result: dict[str, Any] = {"operation": operation}
+    if refreshed_vm is not None:
+        refreshed_vm["last_operation"] = operation
+        result["vm"] = _to_public_vm(refreshed_vm)
+    return "ok", result
+
+
+def fail_unfinished_vm_operations(db_path: Path, reason: str = "master restarted") -> int:
+    """Fail every queued/running operation, e.g. after an unclean master restart."""
+    with _conn(db_path, immediate=True) as conn:
+        rows = conn.execute(
+            "SELECT id, node_id, vm_id, operation_type FROM vm_operations"
+            " WHERE status IN ('queued', 'running');"
+        ).fetchall()
+        if not rows:
+            return 0
+        now = _utc_now_iso()
+        # Three prepared statements bound N times each, instead of 3N
+        # execute calls through the Python/C boundary.
+        conn.executemany(
+            "UPDATE vm_operations SET status = 'failed', error = ?,"
+            " started_at = COALESCE(started_at, ?), ended_at = ? WHERE id = ?;",
+            [(reason, now, now, row["id"]) for row in rows],
+        )
+        vm_updates = [(now, row["vm_id"]) for row in rows if row["vm_id"]]
+        if vm_updates:
+            conn.executemany(
+                "UPDATE node_vms SET state = 'error', updated_at = ? WHERE id = ?;",
+                vm_updates,
+            )
+        conn.executemany(
+            _SQL_LOG_INSERT,
+            [
+                (
+                    row["node_id"],
+                    now,
+                    "warning",
+                    f"vm operation {row['operation_type']} failed: {reason}",
+                    _json_dumps({"operation_id": row["id"], "vm_id": row["vm_id"]}),
+                )
+                for row in rows
+            ],
+        )
+    return len(rows)
+
+
+def fail_stale_vm_operations(db_path: Path, max_age_minutes: int = 30) -> int:
+    """Fail queued operations older than the cutoff that no agent ever claimed."""
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=max(1, int(max_age_minutes)))
+    failed = 0
+    with _conn(db_path, immediate=True) as conn:
+        # created_at is ISO-8601 UTC, so lexicographic order is chronological
+        # order and the age filter can run as an index range scan instead of
+        # a per-row datetime.fromisoformat in Python.
+        rows = conn.execute(
+            "SELECT id, node_id, vm_id, operation_type FROM vm_operations"
+            " WHERE status = 'queued' AND created_at < ?;",
+            (cutoff.isoformat(),),
+        ).fetchall()
+        now = _utc_now_iso()
+        for row in rows:
+            conn.execute(
+                "UPDATE vm_operations SET status = 'failed', error = 'operation timed out',"
+                " started_at = COALESCE(started_at, ?), ended_at = ? WHERE id = ?;",
+                (now, now, row["id"]),
+            )
+            if row["vm_id"]:
+                conn.execute(
+                    "UPDATE node_vms SET state = 'error', updated_at = ? WHERE id = ?;",
+                    (now, row["vm_id"]),
+                )
+            _insert_node_log(
+                conn,
+                row["node_id"],
+                "warning",
+                f"vm operation {row['operation_type']} timed out",
+                {"operation_id": row["id"], "vm_id": row["vm_id"]},
+            )
+            failed += 1
+    return failed